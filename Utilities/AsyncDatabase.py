@@ -0,0 +1,265 @@
+import asyncio
+import functools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from peewee import SelectBase
+
+# отложенные до коммита пакета действия текущей записи в потоке-писателе
+_pending = threading.local()
+
+
+def after_commit(callback):
+    """Выполняет callback после коммита пакета GroupCommitWriter, в который входит текущая запись
+
+    Вне пакетной записи callback выполняется сразу. Если запись или весь пакет откатились,
+    callback не выполняется, поэтому в нем обновляют кэши и индексы в памяти.
+    """
+    callbacks = getattr(_pending, "callbacks", None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+class PoolMetrics:
+    """Счетчики очереди потоков: число вызовов, ожидание в очереди, время выполнения, занятость"""
+    __slots__ = ("calls", "wait_total", "wait_max", "run_total", "busy", "busy_max", "_lock")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.busy = 0
+        self.busy_max = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "wait_avg": self.wait_total / self.calls if self.calls else 0.0,
+            "wait_max": self.wait_max,
+            "run_avg": self.run_total / self.calls if self.calls else 0.0,
+            "busy": self.busy,
+            "busy_max": self.busy_max,
+        }
+
+    def started(self, waited: float):
+        with self._lock:
+            self.calls += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.busy += 1
+            self.busy_max = max(self.busy_max, self.busy)
+
+    def finished(self, seconds: float):
+        with self._lock:
+            self.busy -= 1
+            self.run_total += seconds
+
+
+class DatabaseExecutor:
+    """ Класс DatabaseExecutor выполняет блокирующие запросы peewee в выделенных потоках
+
+    Основное применение - не блокировать цикл событий бота запросами к SQLite.
+    Записи выполняются в одном потоке-писателе (run), чтения - в пуле из readers потоков (read).
+    У каждого потока свое соединение peewee; соединения читателей открываются с
+    PRAGMA query_only, в режиме WAL они не ждут писателя и видят все записи,
+    закоммиченные до начала запроса, поэтому чтение после await записи видит ее результат.
+    Очередь ограничена max_pending задачами: при ее заполнении вызывающий
+    ожидает освобождения места, а не накапливает задачи без ограничений.
+
+    """
+
+    def __init__(self, database, max_pending: int = 256,
+                 commit_batch: int = 64, commit_interval: float = 0.005, readers: int = 4):
+        self.database = database
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="database-reader",
+                                           initializer=self._open_reader) if readers else None
+        self.readers = readers
+        self.read_metrics = PoolMetrics()
+        self.write_metrics = PoolMetrics()
+        self.writer = GroupCommitWriter(self, max_batch=commit_batch, max_delay=commit_interval)
+
+    def _open_reader(self):
+        self.database.connect(reuse_if_open=True)
+        self.database.execute_sql("PRAGMA query_only = 1")
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func в потоке-писателе"""
+        return await self._submit(self._executor, self.write_metrics, func, *args, **kwargs)
+
+    async def read(self, func, *args, **kwargs):
+        """Выполняет func, только читающую БД, в пуле читателей"""
+        if self._readers is None:
+            return await self.run(func, *args, **kwargs)
+        return await self._submit(self._readers, self.read_metrics, func, *args, **kwargs)
+
+    async def _submit(self, executor, metrics: PoolMetrics, func, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(executor, functools.partial(
+                    self._measured, metrics, time.perf_counter(), func, *args, **kwargs))
+            finally:
+                self.pending -= 1
+
+    @classmethod
+    def _measured(cls, metrics: PoolMetrics, queued_at: float, func, *args, **kwargs):
+        started = time.perf_counter()
+        metrics.started(started - queued_at)
+        try:
+            return cls._call(func, *args, **kwargs)
+        finally:
+            metrics.finished(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "readers": self.readers,
+            "read": self.read_metrics.as_dict(),
+            "write": self.write_metrics.as_dict(),
+            "batches": self.writer.batches,
+            "batched_writes": self.writer.writes,
+        }
+
+    async def write(self, func, *args, **kwargs):
+        return await self.writer.submit(func, *args, **kwargs)
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, SelectBase):
+            # ленивый запрос выполняется здесь, а не при итерации в цикле событий
+            result = list(result)
+        return result
+
+    def close(self):
+        self.writer.close()
+        self._executor.shutdown(wait=True)
+        if self._readers is not None:
+            self._readers.shutdown(wait=True)
+
+
+class GroupCommitWriter:
+    """ Класс GroupCommitWriter объединяет одновременные записи в одну транзакцию (group commit)
+
+    Записи копятся не дольше max_delay секунд или до max_batch штук, затем выполняются
+    одной транзакцией в потоке DatabaseExecutor. Каждая запись идет в своей точке
+    сохранения, поэтому ошибка одной записи возвращается только ее вызывающему.
+    Действия, зарегистрированные записью через after_commit, выполняются после коммита пакета.
+
+    """
+
+    def __init__(self, executor: DatabaseExecutor, max_batch: int = 64, max_delay: float = 0.005):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.writes = 0
+        self._queue = None
+        self._task = None
+
+    async def submit(self, func, *args, **kwargs):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.executor.max_pending)
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, args, kwargs, future))
+        return await future
+
+    async def _drain(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            if queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                results = await self.executor.run(self._commit, batch)
+            except Exception as ex:
+                results = [(False, ex)] * len(batch)
+
+            self.batches += 1
+            self.writes += len(batch)
+            for (_, _, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _commit(self, batch: list) -> list:
+        database = self.executor.database
+        results = []
+        committed = []
+        with database.atomic():
+            for func, args, kwargs, _ in batch:
+                _pending.callbacks = []
+                try:
+                    with database.atomic():
+                        result = self.executor._call(func, *args, **kwargs)
+                    committed.extend(_pending.callbacks)
+                    results.append((True, result))
+                except Exception as ex:
+                    results.append((False, ex))
+                finally:
+                    _pending.callbacks = None
+        for callback in committed:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        return results
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+class AsyncManager:
+    """ Класс AsyncManager - асинхронный фасад над классом-менеджером запросов
+
+    Каждый статический метод менеджера превращается в корутину, выполняемую
+    через DatabaseExecutor: await AsyncManager(TagManager, executor).get_by_name(...)
+    Методы из batched выполняются через GroupCommitWriter, методы из writes - в потоке-писателе,
+    остальные считаются только читающими и выполняются в пуле читателей.
+    В writes перечисляются также чтения, заполняющие кэши, которые инвалидируются записями:
+    в одном потоке с записями такое чтение не может закэшировать еще не закоммиченное состояние.
+
+    """
+
+    def __init__(self, manager, executor: DatabaseExecutor, batched: tuple = (), writes: tuple = ()):
+        self._manager = manager
+        self._executor = executor
+        self._batched = frozenset(batched)
+        self._writes = frozenset(writes)
+
+    def __getattr__(self, name):
+        method = getattr(self._manager, name)
+        if name in self._batched:
+            run = self._executor.write
+        elif name in self._writes:
+            run = self._executor.run
+        else:
+            run = self._executor.read
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await run(method, *args, **kwargs)
+
+        setattr(self, name, call)
+        return call
@@ -1,7 +1,5 @@
 from peewee import Model, SqliteDatabase
-import json
-with open("config.json") as file:
-    config = json.load(file)
+from Utilities.Config import config
 
 database = SqliteDatabase(config.get('database'), pragmas=dict(journal_mode='wal',
                                                                cache_size=-1 * 64000,
@@ -13,4 +11,4 @@ database = SqliteDatabase(config.get('database'), pragmas=dict(journal_mode='wal
 
 class BaseModel(Model):
     class Meta:
-        database = database
\ No newline at end of file
+        database = database
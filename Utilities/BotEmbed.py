@@ -1,14 +1,43 @@
 from discord import Embed, User
 from discord.ext.commands import AutoShardedBot
 
+FIELD_LIMIT = 1024
+
+
+def enumerated_lines(iter_content, start: int = 1, limit: int = FIELD_LIMIT) -> str:
+    """Нумерованный список, обрезанный по целым строкам до limit символов вместе с многоточием"""
+    lines = []
+    length = 0
+    for number, item in enumerate(iter_content, start):
+        line = f"**{number}**. {item}\n"
+        if length + len(line) > limit:
+            # многоточие входит в limit: убираем последнюю строку, если места под него нет
+            while lines and length + 1 > limit:
+                length -= len(lines.pop())
+            return "".join(lines) + "…"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+
+def enumerated_page(make_embed, name: str, format_row=str, per_page: int = 10):
+    """Возвращает render(rows, page) для KeysetPaginator: страница - нумерованный список в одном поле
+
+    make_embed() создает пустой Embed страницы, format_row(row) - текст строки.
+    """
+    def render(rows, page):
+        embed = make_embed()
+        embed.add_field(name=name, value=enumerated_lines(map(format_row, rows), page * per_page + 1),
+                        inline=True)
+        embed.set_footer(text=f"Страница {page + 1}")
+        return embed
+    return render
+
 
 class BotEmbed(Embed):
     def __init__(self, bot_user: User, title: str = ""):
         super(BotEmbed, self).__init__(title=title, color=0xcfd242)
         self.set_author(name=bot_user.name, icon_url=bot_user.avatar_url)
 
-    def add_enumerated_field(self, iter_content: list, name: str = "Список"):
-        field_content = ''.join([f"**{i[0] + 1}**. {i[1]}\n" for i in enumerate(iter_content)])
-        self.add_field(name=name, value=field_content, inline=True)
-
-
+    def add_enumerated_field(self, iter_content: list, name: str = "Список", start: int = 1):
+        self.add_field(name=name, value=enumerated_lines(iter_content, start), inline=True)
@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """ Класс LRUCache - ограниченный по размеру кэш с вытеснением LRU и временем жизни записей
+
+    Значение None кэшируется как отрицательный результат, отсутствие записи
+    обозначается MISSING. Кэш потокобезопасен: им пользуются и цикл событий,
+    и поток DatabaseExecutor.
+
+    Счетчик generation увеличивается при каждой инвалидации. Читатель запоминает его
+    до запроса к БД и передает в put(): если за время запроса запись была
+    инвалидирована, устаревший результат не попадет в кэш.
+
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, generation: int = None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
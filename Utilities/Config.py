@@ -0,0 +1,13 @@
+"""
+Конфигурация бота.
+
+config.json читается один раз при первом импорте модуля; bot.py и BaseModel
+используют один и тот же словарь config.
+"""
+import json
+import time
+
+_started = time.perf_counter()
+with open("config.json") as file:
+    config = json.load(file)
+load_seconds = time.perf_counter() - _started
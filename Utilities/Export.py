@@ -0,0 +1,40 @@
+import codecs
+import csv
+import gzip
+import json
+from tempfile import SpooledTemporaryFile
+
+FORMATS = ("csv", "jsonl", "csv.gz", "jsonl.gz")
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def write(rows, columns: tuple, fmt: str):
+    """Записывает строки во временный файл и возвращает (файл, количество строк)
+
+    rows - итератор кортежей, например query.tuples().iterator(): строки читаются
+    из курсора по одной и сразу пишутся в файл, поэтому память не зависит от объема выборки.
+    Файл хранится в памяти до SPOOL_SIZE байт, затем переносится на диск.
+    Вызывается в потоке БД, файл возвращается перемотанным в начало.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат {fmt}")
+    spool = SpooledTemporaryFile(max_size=SPOOL_SIZE, mode="w+b")
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if fmt.endswith(".gz") else spool
+    text = codecs.getwriter("utf-8")(raw)
+    count = 0
+    if fmt.startswith("csv"):
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            text.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+            text.write("\n")
+            count += 1
+    if raw is not spool:
+        # закрывает только сжатый поток, spool остается открытым
+        raw.close()
+    spool.seek(0)
+    return spool, count
@@ -0,0 +1,70 @@
+import bisect
+import threading
+
+
+class NameIndex:
+    """ Класс NameIndex - отсортированный индекс имен по серверам
+
+    Имена сервера загружаются из БД функцией loader(guild_id) при первом обращении,
+    затем индекс поддерживается инкрементально через add() и remove().
+    Проверка существования и поиск по префиксу выполняются бинарным поиском за O(log n).
+
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def _guild_names(self, guild_id: int) -> list:
+        names = self._names.get(guild_id)
+        if names is None:
+            with self._lock:
+                names = self._names.get(guild_id)
+                if names is None:
+                    names = self._names[guild_id] = sorted(set(self._loader(guild_id)))
+        return names
+
+    def exists(self, guild_id: int, name: str) -> bool:
+        names = self._guild_names(guild_id)
+        position = bisect.bisect_left(names, name)
+        return position < len(names) and names[position] == name
+
+    def complete(self, guild_id: int, prefix: str, limit: int = 10) -> list:
+        """Возвращает до limit имен, начинающихся с prefix, в алфавитном порядке"""
+        names = self._guild_names(guild_id)
+        start = bisect.bisect_left(names, prefix)
+        result = []
+        for name in names[start:start + limit]:
+            if not name.startswith(prefix):
+                break
+            result.append(name)
+        return result
+
+    def page(self, guild_id: int, after: str = None, limit: int = 10) -> list:
+        """Возвращает до limit имен, идущих по алфавиту после after"""
+        names = self._guild_names(guild_id)
+        start = 0 if after is None else bisect.bisect_right(names, after)
+        return names[start:start + limit]
+
+    def count_prefix(self, guild_id: int, prefix: str) -> int:
+        names = self._guild_names(guild_id)
+        return bisect.bisect_left(names, prefix + "\U0010ffff") - bisect.bisect_left(names, prefix)
+
+    def add(self, guild_id: int, name: str):
+        with self._lock:
+            names = self._names.get(guild_id)
+            if names is None:
+                return
+            position = bisect.bisect_left(names, name)
+            if position == len(names) or names[position] != name:
+                names.insert(position, name)
+
+    def remove(self, guild_id: int, name: str):
+        with self._lock:
+            names = self._names.get(guild_id)
+            if names is None:
+                return
+            position = bisect.bisect_left(names, name)
+            if position < len(names) and names[position] == name:
+                del names[position]
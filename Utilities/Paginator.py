@@ -0,0 +1,94 @@
+import asyncio
+from collections import OrderedDict
+
+from discord import Forbidden, HTTPException
+
+
+class KeysetPaginator:
+    """ Класс KeysetPaginator выводит список постранично с навигацией реакциями
+
+    Страницы запрашиваются по одной: fetch_page(after, limit) возвращает строки, идущие
+    после курсора after, key(row) строит курсор по последней строке страницы,
+    render(rows, page) возвращает Embed страницы. Стоимость вывода зависит
+    от размера страницы, а не от общего количества строк.
+    Последние cache_pages страниц хранятся в памяти, поэтому возврат назад не делает запросов;
+    сессия завершается и кэш освобождается после timeout секунд без действий пользователя.
+
+    """
+    PREVIOUS = "\N{BLACK LEFT-POINTING TRIANGLE}"
+    NEXT = "\N{BLACK RIGHT-POINTING TRIANGLE}"
+    STOP = "\N{BLACK SQUARE FOR STOP}"
+
+    def __init__(self, ctx, fetch_page, key, render, per_page: int = 10, timeout: float = 120.0,
+                 cache_pages: int = 8):
+        self.ctx = ctx
+        self.fetch_page = fetch_page
+        self.key = key
+        self.render = render
+        self.per_page = per_page
+        self.timeout = timeout
+        self.cache_pages = cache_pages
+        self.message = None
+        self._pages = OrderedDict()
+
+    async def load(self, after) -> tuple:
+        page = self._pages.get(after)
+        if page is not None:
+            self._pages.move_to_end(after)
+            return page
+        rows = await self.fetch_page(after, self.per_page + 1)
+        page = self._pages[after] = (rows[:self.per_page], len(rows) > self.per_page)
+        if len(self._pages) > self.cache_pages:
+            self._pages.popitem(last=False)
+        return page
+
+    async def start(self) -> bool:
+        """Отправляет первую страницу; возвращает False, если список пуст"""
+        rows, has_more = await self.load(None)
+        if not rows:
+            return False
+
+        self.message = await self.ctx.send(embed=self.render(rows, 0))
+        if not has_more:
+            return True
+
+        cursors = [None]
+        page = 0
+        for emoji in (self.PREVIOUS, self.NEXT, self.STOP):
+            await self.message.add_reaction(emoji)
+
+        def check(reaction, user):
+            return reaction.message.id == self.message.id and user == self.ctx.author and \
+                   str(reaction.emoji) in (self.PREVIOUS, self.NEXT, self.STOP)
+
+        while True:
+            try:
+                reaction, user = await self.ctx.bot.wait_for('reaction_add', check=check, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                break
+
+            emoji = str(reaction.emoji)
+            if emoji == self.STOP:
+                break
+            if emoji == self.NEXT and has_more:
+                cursors.append(self.key(rows[-1]))
+                page += 1
+            elif emoji == self.PREVIOUS and page > 0:
+                cursors.pop()
+                page -= 1
+            else:
+                continue
+
+            rows, has_more = await self.load(cursors[page])
+            await self.message.edit(embed=self.render(rows, page))
+            try:
+                await self.message.remove_reaction(reaction.emoji, user)
+            except (Forbidden, HTTPException):
+                pass
+
+        self._pages.clear()
+        try:
+            await self.message.clear_reactions()
+        except (Forbidden, HTTPException):
+            pass
+        return True
@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import itertools
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class RestScheduler:
+    """ Класс RestScheduler - общая очередь исходящих запросов к API Discord
+
+    Запросы группируются по корзинам (bucket), повторяющим маршруты Discord, например
+    ("reactions", channel_id) или ("member_roles", guild_id). Корзина соответствует ровно
+    одному маршруту и его лимиту: запросы к одному маршруту нельзя разносить по разным
+    корзинам. Внутри корзины запросы выполняются по очереди, разные корзины - одновременно. Интерактивные запросы
+    (ответы на команды) стоят в корзине раньше фоновых и не ограничены по числу,
+    одновременных фоновых запросов не больше background_concurrency.
+
+    """
+
+    def __init__(self, background_concurrency: int = 4):
+        self.background_concurrency = background_concurrency
+        self._buckets = {}
+        self._workers = {}
+        # корзины, ожидающие слот фонового запроса
+        self._wakeups = {}
+        self._counter = itertools.count()
+        self._background_slots = None
+        self.completed = [0, 0]
+        self.wait_total = [0.0, 0.0]
+        self.wait_max = [0.0, 0.0]
+
+    async def submit(self, bucket, factory, priority: int = BACKGROUND):
+        """Ставит в очередь вызов factory() и возвращает результат его корутины"""
+        if self._background_slots is None:
+            self._background_slots = asyncio.Semaphore(self.background_concurrency)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._buckets.setdefault(bucket, []),
+                       (priority, next(self._counter), loop.time(), factory, future))
+        if bucket not in self._workers:
+            self._workers[bucket] = loop.create_task(self._work(bucket))
+        elif priority == INTERACTIVE and bucket in self._wakeups:
+            self._wakeups[bucket].set()
+        return await future
+
+    def schedule(self, bucket, factory, priority: int = BACKGROUND):
+        """То же, что submit, но без ожидания результата"""
+        task = asyncio.ensure_future(self.submit(bucket, factory, priority))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    async def _work(self, bucket):
+        queue = self._buckets[bucket]
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                if queue[0][0] == INTERACTIVE:
+                    await self._run(*heapq.heappop(queue), loop)
+                    continue
+                # слот берется до извлечения запроса: интерактивный запрос, пришедший
+                # за время ожидания слота, будит корзину и выполняется без слота
+                if not await self._acquire_background(bucket):
+                    continue
+                try:
+                    if queue[0][0] == INTERACTIVE:
+                        continue
+                    await self._run(*heapq.heappop(queue), loop)
+                finally:
+                    self._background_slots.release()
+        finally:
+            del self._workers[bucket]
+            self._wakeups.pop(bucket, None)
+            if not queue:
+                del self._buckets[bucket]
+
+    async def _acquire_background(self, bucket) -> bool:
+        """Ждет слот фонового запроса; возвращает False, если раньше пришел интерактивный запрос"""
+        wakeup = self._wakeups[bucket] = asyncio.Event()
+        acquire = asyncio.ensure_future(self._background_slots.acquire())
+        woken = asyncio.ensure_future(wakeup.wait())
+        try:
+            await asyncio.wait((acquire, woken), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            del self._wakeups[bucket]
+            acquire.cancel()
+            woken.cancel()
+            await asyncio.gather(acquire, woken, return_exceptions=True)
+        acquired = not acquire.cancelled()
+        if acquired and wakeup.is_set():
+            self._background_slots.release()
+            return False
+        return acquired
+
+    async def _run(self, priority, _, enqueued_at, factory, future, loop):
+        waited = loop.time() - enqueued_at
+        self.completed[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        if future.cancelled():
+            return
+        try:
+            result = await factory()
+        except Exception as ex:
+            if not future.cancelled():
+                future.set_exception(ex)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._buckets.values())
+
+    def stats(self) -> dict:
+        def average(priority):
+            count = self.completed[priority]
+            return self.wait_total[priority] / count if count else 0.0
+
+        return {
+            "depth": self.depth(),
+            "buckets": len(self._workers),
+            "interactive": (self.completed[INTERACTIVE], average(INTERACTIVE), self.wait_max[INTERACTIVE]),
+            "background": (self.completed[BACKGROUND], average(BACKGROUND), self.wait_max[BACKGROUND]),
+        }
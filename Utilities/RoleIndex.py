@@ -0,0 +1,62 @@
+class RoleIndex:
+    """ Класс RoleIndex - индекс участников сервера по ролям
+
+    Для каждого сервера хранит словарь role_id -> множество member_id. Индекс сервера
+    строится одним проходом по guild.members при первом обращении, затем поддерживается
+    событиями участников, поэтому выборка участников роли не перебирает весь сервер.
+
+    """
+
+    def __init__(self):
+        self._guilds = {}
+
+    def _index(self, guild) -> dict:
+        index = self._guilds.get(guild.id)
+        if index is None:
+            index = self._guilds[guild.id] = {}
+            for member in guild.members:
+                for role in member.roles:
+                    index.setdefault(role.id, set()).add(member.id)
+        return index
+
+    def members(self, guild, role_id: int) -> frozenset:
+        return frozenset(self._index(guild).get(role_id, ()))
+
+    def has_role(self, guild, role_id: int, member_id: int) -> bool:
+        return member_id in self._index(guild).get(role_id, ())
+
+    def update(self, before, after) -> tuple:
+        """Учитывает смену ролей участника; возвращает множества id добавленных и снятых ролей"""
+        added = {role.id for role in after.roles} - {role.id for role in before.roles}
+        removed = {role.id for role in before.roles} - {role.id for role in after.roles}
+        index = self._guilds.get(after.guild.id)
+        if index is not None:
+            for role_id in added:
+                index.setdefault(role_id, set()).add(after.id)
+            for role_id in removed:
+                members = index.get(role_id)
+                if members is not None:
+                    members.discard(after.id)
+        return added, removed
+
+    def add_member(self, member):
+        index = self._guilds.get(member.guild.id)
+        if index is not None:
+            for role in member.roles:
+                index.setdefault(role.id, set()).add(member.id)
+
+    def remove_member(self, member):
+        index = self._guilds.get(member.guild.id)
+        if index is not None:
+            for role in member.roles:
+                members = index.get(role.id)
+                if members is not None:
+                    members.discard(member.id)
+
+    def remove_role(self, guild_id: int, role_id: int):
+        index = self._guilds.get(guild_id)
+        if index is not None:
+            index.pop(role_id, None)
+
+    def remove_guild(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import itertools
+import traceback
+from datetime import datetime
+
+
+class TimerScheduler:
+    """ Класс TimerScheduler - планировщик таймеров на min-куче, упорядоченной по времени срабатывания
+
+    Хранит записи ключ -> (время, данные). Отмена и перепланирование ленивые: устаревшие
+    элементы кучи отбрасываются при извлечении. Добавление, отмена и извлечение - O(log n).
+    Цикл run() спит ровно до ближайшего срока и просыпается раньше, если добавлен более ранний таймер.
+
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, when: datetime, payload):
+        seq = next(self._counter)
+        self._entries[key] = (when, seq, payload)
+        heapq.heappush(self._heap, (when, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key) -> bool:
+        if self._entries.pop(key, None) is None:
+            return False
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+        return True
+
+    def next_due(self):
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> list:
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, _, key = heapq.heappop(self._heap)
+            due.append(self._entries.pop(key)[2])
+
+    def _is_live(self, item) -> bool:
+        entry = self._entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+
+    def _compact(self):
+        self._heap = [item for item in self._heap if self._is_live(item)]
+        heapq.heapify(self._heap)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            when = self.next_due()
+            if when is None:
+                await self._wakeup.wait()
+                continue
+
+            delay = (when - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self.pop_due(datetime.now())
+            try:
+                await self._callback(due)
+            except Exception:
+                traceback.print_exc()
@@ -1,19 +1,21 @@
+import time
+STARTED = time.perf_counter()
+
+import asyncio
 import datetime
 import sys
 import traceback
-from cogs import reminder, Study, tags, Utils
+from contextlib import contextmanager
+from cogs import Utils
 from discord.ext import commands
 import discord
-import json
-from playhouse.sqlite_ext import *
-from Utilities import BaseModel
+from Utilities import BaseModel, AsyncDatabase, Config, RestScheduler
+from Utilities.Config import config
+import migrations
 description = """
 Бот написан для реализации дистанционного обучения в рамках программы 'Discord'.
 """
 
-with open("config.json") as file:
-    config = json.load(file)
-
 initial_extensions = (
     'cogs.admin',
     'cogs.tags',
@@ -24,10 +26,18 @@ initial_extensions = (
 )
 
 
+# guild_id -> префикс; один объект словаря с bot.prefixes, меняется только на месте.
+# Глобальные имена читаются быстрее атрибутов бота на каждом сообщении
+prefixes = {}
+default_prefix = config.get('prefix')
+
+
 def _prefix_callable(bot, msg):
-    """Returns the prefix."""
-    prefix = config.get('prefix')
-    return prefix
+    """Returns the guild prefix from the in-memory map, or the default one."""
+    guild = msg.guild
+    if guild is None:
+        return default_prefix
+    return prefixes.get(guild.id, default_prefix)
 
 
 class StudyBot(commands.AutoShardedBot):
@@ -44,24 +54,117 @@ class StudyBot(commands.AutoShardedBot):
         )
         super().__init__(command_prefix=_prefix_callable, description=description,
                          pm_help=None, allowed_mentions=allowed_mentions, intents=intents)
+        self.config = config
+        self.timings = [('config', Config.load_seconds), ('imports', time.perf_counter() - STARTED)]
+        self.warmed = asyncio.Event()
         self.client_id = config.get('client_id')
+        self.db = AsyncDatabase.DatabaseExecutor(BaseModel.database,
+                                                 max_pending=config.get('db_max_pending', 256),
+                                                 commit_batch=config.get('db_commit_batch', 64),
+                                                 commit_interval=config.get('db_commit_interval', 0.005),
+                                                 readers=config.get('db_readers', 4))
+
+        self.rest = RestScheduler.RestScheduler(
+            background_concurrency=config.get('rest_background_concurrency', 4))
+
+        with self.stage('schema'):
+            applied = migrations.migrate(BaseModel.database)
+        if applied:
+            print(f'Applied schema migrations: {applied}')
+
+        with self.stage('prefixes'):
+            # словарь читается на каждом сообщении, поэтому заполняется до подключения
+            self.default_prefix = default_prefix
+            self.prefixes = prefixes
+            self.prefixes.update(Utils.PrefixManager.get_all())
+
+        with self.stage('extensions'):
+            for extension in initial_extensions:
+                try:
+                    self.load_extension(extension)
+                except Exception as e:
+                    print(f'Failed to load extension {extension}.', file=sys.stderr)
+                    traceback.print_exc()
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - started))
 
-        for extension in initial_extensions:
-            try:
-                self.load_extension(extension)
-            except Exception as e:
-                print(f'Failed to load extension {extension}.', file=sys.stderr)
-                traceback.print_exc()
+    async def on_connect(self):
+        if not hasattr(self, 'connected_after'):
+            self.connected_after = time.perf_counter() - STARTED
 
     async def on_ready(self):
-        if not hasattr(self, 'uptime'):
-            self.uptime = datetime.datetime.utcnow()
+        if hasattr(self, 'uptime'):
+            print(f'Reconnected: {self.user} (ID: {self.user.id})')
+            return
+        self.uptime = datetime.datetime.utcnow()
+        ready_after = time.perf_counter() - STARTED
 
         print(f'Ready: {self.user} (ID: {self.user.id})')
+        await self.warm_up()
+        print('Startup timings:')
+        for name, seconds in self.timings:
+            print(f'  {name:<24} {seconds * 1000:8.1f} ms')
+        print(f'Gateway connected after {self.connected_after:.2f} s, ready after {ready_after:.2f} s, '
+              f'fully ready after {time.perf_counter() - STARTED:.2f} s')
 
-        BaseModel.database.create_tables([tags.Tag, tags.TagIndex, reminder.Reminders,
-                                          Study.Student, Study.Exercise, Study.DoneExercises,
-                                          Utils.RoleMessages, Study.Groups])
+    async def warm_up(self):
+        """Запускает warm_up() всех расширений: загрузку кэшей и индексов из БД
+
+        Расширения стартуют одновременно: их чтения идут параллельно в пуле читателей
+        DatabaseExecutor (db_readers потоков), последовательно выполняются только записи.
+        """
+        with self.stage('warm-up total'):
+            await asyncio.gather(*(self.warm_up_cog(cog) for cog in self.cogs.values() if hasattr(cog, 'warm_up')))
+        self.warmed.set()
+
+    async def warm_up_cog(self, cog):
+        started = time.perf_counter()
+        try:
+            await cog.warm_up()
+        except Exception:
+            print(f'Failed to warm up {cog.qualified_name}.', file=sys.stderr)
+            traceback.print_exc()
+        self.timings.append((f'warm-up {cog.qualified_name}', time.perf_counter() - started))
+
+    def is_warm(self) -> bool:
+        return self.warmed.is_set()
+
+    def warm_up_if_ready(self, cog):
+        """Прогревает расширение, загруженное командой load/reload после запуска бота"""
+        if self.is_warm():
+            self.loop.create_task(self.warm_up_cog(cog))
+
+    async def wait_until_warm(self):
+        """Ожидает завершения warm_up всех расширений после первого on_ready"""
+        await self.warmed.wait()
+
+    async def close(self):
+        await super().close()
+        self.db.close()
 
     def run(self):
         super().run(config["token"], reconnect=True)
+
+
+if __name__ == "__main__":
+    import timeit
+    from types import SimpleNamespace
+
+    # замер _prefix_callable на каждом сообщении: python bot.py
+    prefixes.update({guild_id: '?' for guild_id in range(0, 20000, 2)})
+    cases = (
+        ("config lookup", lambda bot, msg: config.get('prefix'), SimpleNamespace(guild=SimpleNamespace(id=4))),
+        ("custom prefix", _prefix_callable, SimpleNamespace(guild=SimpleNamespace(id=4))),
+        ("default prefix", _prefix_callable, SimpleNamespace(guild=SimpleNamespace(id=5))),
+        ("direct message", _prefix_callable, SimpleNamespace(guild=None)),
+    )
+    runs = 1000000
+    for name, func, msg in cases:
+        seconds = min(timeit.repeat(lambda: func(None, msg), number=runs, repeat=5))
+        print(f"{name:16} {seconds / runs * 1e9:6.0f} ns/call")
@@ -1,15 +1,309 @@
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncio
+import json
+import sys
+import traceback
+from datetime import datetime
+
+import discord
+from peewee import BooleanField, DateTimeField, EXCLUDED, ForeignKeyField, IntegerField, TextField, chunked
+from playhouse.sqlite_ext import AutoIncrementField
+
+from Utilities import BaseModel, TimeParser
+from Utilities.AsyncDatabase import AsyncManager
+from Utilities.RestScheduler import INTERACTIVE
+from Utilities.Scheduler import TimerScheduler
+
 
 def to_emoji(c):
     base = 0x1f1e6
     return chr(base + c)
 
+
+class Poll(BaseModel.BaseModel):
+    id = AutoIncrementField(primary_key=True)
+    message_id = IntegerField(null=False, unique=True)
+    channel_id = IntegerField(null=False)
+    guild_id = IntegerField(null=False)
+    author_id = IntegerField(null=False)
+    question = TextField(null=False)
+    options = TextField(null=False)
+    closes_at = DateTimeField(null=True)
+    closed = BooleanField(default=False)
+
+
+class PollVote(BaseModel.BaseModel):
+    poll = ForeignKeyField(model=Poll, on_delete='CASCADE')
+    user_id = IntegerField(null=False)
+    option = IntegerField(null=False)
+
+    class Meta:
+        indexes = (
+            (('poll', 'user_id'), True),
+        )
+
+
+class PollManager:
+
+    @staticmethod
+    def insert(poll: Poll):
+        with BaseModel.database.atomic():
+            return poll.save()
+
+    @staticmethod
+    def get_open() -> list:
+        return list(Poll.select().where(Poll.closed == False))
+
+    @staticmethod
+    def get_votes(poll_ids: list) -> list:
+        """Возвращает голоса кортежами (poll_id, user_id, option)"""
+        votes = []
+        for batch in chunked(poll_ids, 500):
+            query = (PollVote
+                     .select(PollVote.poll, PollVote.user_id, PollVote.option)
+                     .where(PollVote.poll.in_(batch)))
+            votes.extend(query.tuples())
+        return votes
+
+    @staticmethod
+    def save_votes(changes: dict):
+        """Записывает изменения голосов {poll_id: {user_id: option или None}} одной транзакцией"""
+        upserts = [(poll_id, user_id, option)
+                   for poll_id, users in changes.items()
+                   for user_id, option in users.items() if option is not None]
+        with BaseModel.database.atomic():
+            for batch in chunked(upserts, 300):
+                (PollVote
+                 .insert_many(batch, fields=[PollVote.poll, PollVote.user_id, PollVote.option])
+                 .on_conflict(conflict_target=[PollVote.poll, PollVote.user_id],
+                              update={PollVote.option: EXCLUDED.option})
+                 .execute())
+            for poll_id, users in changes.items():
+                removed = [user_id for user_id, option in users.items() if option is None]
+                for batch in chunked(removed, 500):
+                    PollVote.delete().where((PollVote.poll == poll_id) &
+                                            (PollVote.user_id.in_(batch))).execute()
+
+    @staticmethod
+    def close(poll_id: int):
+        return Poll.update(closed=True).where(Poll.id == poll_id).execute()
+
+
+class PollState:
+    """ Класс PollState - состояние открытого опроса в памяти
+
+    Голос пользователя и счетчики вариантов обновляются за O(1) на событие реакции.
+    У каждого пользователя один голос: новая реакция переносит голос на другой вариант.
+    Изменения копятся в dirty до периодической записи в БД.
+
+    """
+    __slots__ = ('poll_id', 'message_id', 'channel_id', 'guild_id', 'author_id', 'question', 'options',
+                 'emojis', 'counts', 'votes', 'dirty', 'closes_at')
+
+    def __init__(self, poll: Poll):
+        self.poll_id = poll.id
+        self.message_id = poll.message_id
+        self.channel_id = poll.channel_id
+        self.guild_id = poll.guild_id
+        self.author_id = poll.author_id
+        self.question = poll.question
+        self.options = json.loads(poll.options)
+        self.emojis = {to_emoji(i): i for i in range(len(self.options))}
+        self.counts = [0] * len(self.options)
+        self.votes = {}
+        self.dirty = {}
+        self.closes_at = poll.closes_at
+
+    def load_vote(self, user_id: int, option: int):
+        if 0 <= option < len(self.counts):
+            self.votes[user_id] = option
+            self.counts[option] += 1
+
+    def vote(self, user_id: int, option: int):
+        """Возвращает предыдущий вариант пользователя, если голос был перенесен"""
+        previous = self.votes.get(user_id)
+        if previous == option:
+            return None
+        if previous is not None:
+            self.counts[previous] -= 1
+        self.votes[user_id] = option
+        self.counts[option] += 1
+        self.dirty[user_id] = option
+        return previous
+
+    def unvote(self, user_id: int, option: int):
+        if self.votes.get(user_id) != option:
+            return
+        del self.votes[user_id]
+        self.counts[option] -= 1
+        self.dirty[user_id] = None
+
+    def reconcile(self, reactions: dict):
+        """Приводит голоса к реакциям сообщения {user_id: [варианты]}; изменения попадают в dirty"""
+        for user_id, option in list(self.votes.items()):
+            if option not in reactions.get(user_id, ()):
+                self.unvote(user_id, option)
+        for user_id, options in reactions.items():
+            if user_id not in self.votes:
+                self.vote(user_id, options[0])
+
+    def format_results(self, title: str) -> str:
+        total = sum(self.counts) or 1
+        lines = [f"{title}: {self.question}\n"]
+        for i, (option, count) in enumerate(zip(self.options, self.counts)):
+            bar = "\N{FULL BLOCK}" * round(10 * count / total)
+            lines.append(f"{to_emoji(i)} {option} — **{count}** ({count / total:.0%}) {bar}")
+        lines.append(f"\nВсего голосов: {sum(self.counts)}")
+        return "\n".join(lines)
+
+
 class Polls(commands.Cog):
     """Poll voting system."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.poll_manager = AsyncManager(PollManager, bot.db, batched=("insert",), writes=("close", "save_votes"))
+        # message_id -> PollState
+        self.polls = {}
+        self.deadlines = TimerScheduler(self.close_polls)
+        self.deadlines_task = bot.loop.create_task(self.run_deadlines())
+        self.reconcile_task = None
+        self.flush_votes.start()
+        bot.warm_up_if_ready(self)
+
+    def cog_unload(self):
+        self.deadlines_task.cancel()
+        if self.reconcile_task is not None:
+            self.reconcile_task.cancel()
+        self.flush_votes.cancel()
+
+    async def warm_up(self):
+        polls = await self.poll_manager.get_open()
+        for poll in polls:
+            self.track(PollState(poll))
+        states = {state.poll_id: state for state in self.polls.values()}
+        for poll_id, user_id, option in await self.poll_manager.get_votes(list(states)):
+            states[poll_id].load_vote(user_id, option)
+        # сверка с реакциями идет через REST и не задерживает завершение запуска
+        self.reconcile_task = self.bot.loop.create_task(self.reconcile(list(states.values())))
+
+    async def reconcile(self, states: list):
+        """Сверяет голоса открытых опросов с реакциями, поставленными и снятыми, пока бот был недоступен"""
+        await asyncio.gather(*(self.reconcile_poll(state) for state in states))
+        await self.save_dirty(states)
+
+    async def reconcile_poll(self, state: PollState):
+        try:
+            reactions = await self.bot.rest.submit(("reactions", state.channel_id),
+                                                   lambda: self.fetch_reactions(state))
+        except discord.HTTPException:
+            print(f'Failed to reconcile votes of poll {state.poll_id}.', file=sys.stderr)
+            traceback.print_exc()
+            return
+        if self.polls.get(state.message_id) is state:
+            state.reconcile(reactions)
+
+    async def fetch_reactions(self, state: PollState) -> dict:
+        """Варианты, отмеченные реакциями на сообщении опроса: {user_id: [варианты]}"""
+        channel = self.bot.get_channel(state.channel_id) or await self.bot.fetch_channel(state.channel_id)
+        message = await channel.fetch_message(state.message_id)
+        reactions = {}
+        for reaction in message.reactions:
+            option = state.emojis.get(str(reaction.emoji))
+            if option is None:
+                continue
+            async for user in reaction.users():
+                if user.id != self.bot.user.id:
+                    reactions.setdefault(user.id, []).append(option)
+        return reactions
+
+    async def run_deadlines(self):
+        await self.bot.wait_until_warm()
+        await self.deadlines.run()
+
+    def track(self, state: PollState):
+        self.polls[state.message_id] = state
+        if state.closes_at is not None:
+            self.deadlines.schedule(state.poll_id, state.closes_at, state)
+
+    async def create_poll(self, ctx, message, question: str, options: list, closes_at: datetime = None):
+        poll = Poll(message_id=message.id,
+                    channel_id=message.channel.id,
+                    guild_id=ctx.guild.id,
+                    author_id=ctx.author.id,
+                    question=question,
+                    options=json.dumps(options, ensure_ascii=False),
+                    closes_at=closes_at)
+        await self.poll_manager.insert(poll)
+        self.track(PollState(poll))
+
+    def add_reactions(self, message, emojis: list):
+        # реакции ставятся в очередь канала, команда не ждет все 20 запросов
+        for emoji in emojis:
+            self.bot.rest.schedule(("reactions", message.channel.id), lambda e=emoji: message.add_reaction(e))
+
+    @tasks.loop(seconds=30.0)
+    async def flush_votes(self):
+        await self.save_dirty(list(self.polls.values()))
+
+    @flush_votes.before_loop
+    async def before_flush(self):
+        await self.bot.wait_until_warm()
+
+    async def save_dirty(self, states: list):
+        changes = {}
+        for state in states:
+            if state.dirty:
+                changes[state.poll_id], state.dirty = state.dirty, {}
+        if not changes:
+            return
+        try:
+            await self.poll_manager.save_votes(changes)
+        except Exception:
+            traceback.print_exc()
+            # вернуть несохраненные изменения, не затирая более новые
+            for state in states:
+                for user_id, option in changes.get(state.poll_id, {}).items():
+                    state.dirty.setdefault(user_id, option)
+
+    async def close_polls(self, states: list):
+        for state in states:
+            await self.close_poll(state)
+
+    async def close_poll(self, state: PollState):
+        self.polls.pop(state.message_id, None)
+        self.deadlines.cancel(state.poll_id)
+        await self.save_dirty([state])
+        await self.poll_manager.close(state.poll_id)
+        channel = self.bot.get_channel(state.channel_id)
+        if channel is not None:
+            try:
+                await channel.send(state.format_results("Опрос завершен"))
+            except discord.HTTPException:
+                traceback.print_exc()
+
+    @commands.Cog.listener(name="on_raw_reaction_add")
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        state = self.polls.get(payload.message_id)
+        if state is None or payload.user_id == self.bot.user.id:
+            return
+        option = state.emojis.get(str(payload.emoji))
+        if option is None:
+            return
+        previous = state.vote(payload.user_id, option)
+        if previous is not None:
+            self.bot.rest.schedule(("reactions", state.channel_id),
+                                   lambda: self.bot.http.remove_reaction(state.channel_id, state.message_id,
+                                                                         to_emoji(previous), payload.user_id))
+
+    @commands.Cog.listener(name="on_raw_reaction_remove")
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        state = self.polls.get(payload.message_id)
+        if state is None:
+            return
+        option = state.emojis.get(str(payload.emoji))
+        if option is not None:
+            state.unvote(payload.user_id, option)
 
     @commands.command(name="опрос")
     @commands.guild_only()
@@ -39,15 +333,32 @@ class Polls(commands.Cog):
 
             answers.append((to_emoji(i), entry.clean_content))
 
+        closes_at = None
+        messages.append(await ctx.send('Когда закрыть опрос? Например, "через 2 часа" или "-" без срока.'))
+        try:
+            entry = await self.bot.wait_for('message', check=check, timeout=60.0)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            messages.append(entry)
+            if entry.content.strip() != '-':
+                try:
+                    closes_at = TimeParser.parse(entry.content)
+                except TimeParser.TimeParseError as error:
+                    messages.append(await ctx.send(f'{error.message}. Опрос будет без срока.'))
+
         try:
             await ctx.channel.delete_messages(messages)
         except:
             pass # oh well
 
         answer = '\n'.join(f'{keycap}: {content}' for keycap, content in answers)
-        actual_poll = await ctx.send(f'{ctx.author} asks: {question}\n\n{answer}')
-        for emoji, _ in answers:
-            await actual_poll.add_reaction(emoji)
+        deadline = f'\n\nОпрос закроется {closes_at:%Y-%m-%d %H:%M}' if closes_at else ''
+        actual_poll = await self.bot.rest.submit(
+            ("messages", ctx.channel.id),
+            lambda: ctx.send(f'{ctx.author} asks: {question}\n\n{answer}{deadline}'), INTERACTIVE)
+        await self.create_poll(ctx, actual_poll, question, [content for _, content in answers], closes_at)
+        self.add_reactions(actual_poll, [emoji for emoji, _ in answers])
 
     @poll.error
     async def poll_error(self, ctx, error):
@@ -79,10 +390,41 @@ class Polls(commands.Cog):
             pass
 
         body = "\n".join(f"{key}: {c}" for key, c in choices)
-        poll = await ctx.send(f'{ctx.author} asks: {question}\n\n{body}')
-        for emoji, _ in choices:
-            await poll.add_reaction(emoji)
+        poll = await self.bot.rest.submit(("messages", ctx.channel.id),
+                                          lambda: ctx.send(f'{ctx.author} asks: {question}\n\n{body}'), INTERACTIVE)
+        await self.create_poll(ctx, poll, question, [c for _, c in choices])
+        self.add_reactions(poll, [emoji for emoji, _ in choices])
+
+    def get_guild_poll(self, ctx, message_id: int):
+        """Открытый опрос по ID сообщения, только если он создан на сервере команды"""
+        state = self.polls.get(message_id)
+        if state is None or state.guild_id != ctx.guild.id:
+            return None
+        return state
+
+    @commands.command(name="итоги")
+    @commands.guild_only()
+    async def poll_results(self, ctx, message_id: int):
+        """Выводит текущие результаты открытого опроса по ID его сообщения"""
+        state = self.get_guild_poll(ctx, message_id)
+        if state is None:
+            return await ctx.send("Открытый опрос с таким ID сообщения не найден")
+        await ctx.send(state.format_results("Промежуточные итоги"))
+
+    @commands.command(name="закрыть")
+    @commands.guild_only()
+    async def close_poll_command(self, ctx, message_id: int):
+        """Закрывает опрос по ID его сообщения и публикует результаты"""
+        state = self.get_guild_poll(ctx, message_id)
+        if state is None:
+            return await ctx.send("Открытый опрос с таким ID сообщения не найден")
+        # права модератора проверяются в канале опроса, а не в канале команды
+        channel = self.bot.get_channel(state.channel_id)
+        permissions = channel.permissions_for(ctx.author) if channel is not None else ctx.author.guild_permissions
+        if state.author_id != ctx.author.id and not permissions.manage_messages:
+            return await ctx.send("Закрыть опрос может только его автор или модератор")
+        await self.close_poll(state)
 
 
 def setup(bot):
-    bot.add_cog(Polls(bot))
\ No newline at end of file
+    bot.add_cog(Polls(bot))
@@ -1,12 +1,21 @@
 from discord.ext import commands
 
+import asyncio
 import datetime
 import logging
+import traceback
 from datetime import datetime
-from discord import Embed, Role, Member, PermissionOverwrite
+from discord import Embed, File, Role, Member, PermissionOverwrite, utils
 
-from Utilities import BaseModel
-from playhouse.sqlite_ext import *
+from peewee import (BooleanField, DateTimeField, DoesNotExist, EXCLUDED, ForeignKeyField, IntegerField,
+                    IntegrityError, JOIN, TextField, chunked, fn)
+from playhouse.sqlite_ext import AutoIncrementField
+
+from Utilities import BaseModel, BotEmbed, Export
+from Utilities.Paginator import KeysetPaginator
+from Utilities.RoleIndex import RoleIndex
+from Utilities.AsyncDatabase import AsyncManager
+from Utilities.RestScheduler import INTERACTIVE
 
 logging.basicConfig(filename='bots_errors.log', level=logging.ERROR)
 logger = logging.getLogger('peewee')
@@ -16,8 +25,14 @@ logger.setLevel(logging.ERROR)
 
 class Groups(BaseModel.BaseModel):
     id = AutoIncrementField(primary_key=True)
-    group_name = TextField(null=False, unique=True)
+    group_name = TextField(null=False)
     guild_id = IntegerField(null=False)
+    auto_sync = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('guild_id', 'group_name'), True),
+        )
 
 
 class Exercise(BaseModel.BaseModel):
@@ -36,6 +51,11 @@ class Student(BaseModel.BaseModel):
     group_id = ForeignKeyField(model=Groups, on_delete='SET NULL')
     guild_id = IntegerField(null=False)
 
+    class Meta:
+        indexes = (
+            (('member_id', 'guild_id'), True),
+        )
+
 
 class DoneExercises(BaseModel.BaseModel):
     id = AutoIncrementField(primary_key=True)
@@ -45,6 +65,32 @@ class DoneExercises(BaseModel.BaseModel):
     student_result = TextField(null=False)
 
 
+class GradebookCell(BaseModel.BaseModel):
+    id = AutoIncrementField(primary_key=True)
+    student = ForeignKeyField(model=Student, on_delete='CASCADE')
+    exercise = ForeignKeyField(model=Exercise, on_delete='CASCADE')
+    attempts = IntegerField(default=0)
+    first_done_at = DateTimeField(null=True)
+    last_done_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('student', 'exercise'), True),
+        )
+
+
+class ExerciseProgress(BaseModel.BaseModel):
+    id = AutoIncrementField(primary_key=True)
+    exercise = ForeignKeyField(model=Exercise, unique=True, on_delete='CASCADE')
+    submitted = IntegerField(default=0)
+
+
+class StudentProgress(BaseModel.BaseModel):
+    id = AutoIncrementField(primary_key=True)
+    student = ForeignKeyField(model=Student, unique=True, on_delete='CASCADE')
+    submitted = IntegerField(default=0)
+
+
 class GroupManager:
 
     @staticmethod
@@ -54,18 +100,38 @@ class GroupManager:
         return group.save()
 
     @staticmethod
-    def delete(group_name: str, guild_id: int):
+    def delete(group_name: str, guild_id: int) -> int:
+        """Удаляет группу; возвращает ее id"""
         group = Groups.get((Groups.group_name == group_name) & (Groups.guild_id == guild_id))
-        return group.delete_instance()
+        group.delete_instance()
+        return group.id
 
     @staticmethod
-    def get_with_count(guild_id: int):
+    def set_auto_sync(group_name: str, guild_id: int, enabled: bool) -> int:
+        """Включает или выключает автообновление группы; возвращает id группы"""
+        group = GroupManager.get_by_name(group_name, guild_id)
+        group.auto_sync = enabled
+        group.save()
+        return group.id
+
+    @staticmethod
+    def get_auto_sync() -> list:
+        """Кортежи (guild_id, название, id) групп с автообновлением"""
         query = (Groups
-                 .select(Groups.group_name, fn.COUNT(Student.id).alias("count"))
+                 .select(Groups.guild_id, Groups.group_name, Groups.id)
+                 .where(Groups.auto_sync == True))
+        return list(query.tuples())
+
+    @staticmethod
+    def get_page_with_count(guild_id: int, after: str = None, limit: int = 10) -> list:
+        """Страница кортежей (название группы, количество студентов) после группы after"""
+        query = (Groups
+                 .select(Groups.group_name, fn.COUNT(Student.id))
                  .join_from(Groups, Student, JOIN.LEFT_OUTER)
-                 .where(Groups.guild_id == guild_id)
-                 .group_by(Groups.group_name))
-        return [(group.group_name, group.count) for group in query]
+                 .where(Groups.guild_id == guild_id))
+        if after is not None:
+            query = query.where(Groups.group_name > after)
+        return list(query.group_by(Groups.id).order_by(Groups.group_name).limit(limit).tuples())
 
     @staticmethod
     def get_by_name(group_name: str, guild_id: int):
@@ -94,18 +160,17 @@ class ExerciseManager:
             return exercise
 
     @staticmethod
-    def get_by_student(member_id: int, guild_id: int):
-        try:
-            student = StudentManager.get_by_id(member_id, guild_id)
-
-            exercise = Exercise.select().where((Exercise.group_id == student.group_id) &
-                                               (Exercise.guild_id == guild_id))
-        except DoesNotExist as ex:
-            logger.exception(ex)
-            logger.exception(f"\nExercise with title {member_id} doesn't exist!\n")
-
-        else:
-            return exercise
+    def get_by_student(member_id: int, guild_id: int) -> list:
+        """Названия заданий группы студента одним запросом"""
+        query = (Exercise
+                 .select(Exercise.title)
+                 .join(Student, on=(Student.group_id == Exercise.group_id))
+                 .where((Student.member_id == member_id) &
+                        (Student.guild_id == guild_id) &
+                        (Exercise.guild_id == guild_id))
+                 .order_by(Exercise.id)
+                 .tuples())
+        return [title for title, in query]
 
     @staticmethod
     def update(title: str, guild_id: int, content: str):
@@ -120,13 +185,17 @@ class ExerciseManager:
             return exercise.save()
 
     @staticmethod
-    def get_all_by_group(group_name: str, guild_id: int):
-        group = GroupManager.get_by_name(group_name, guild_id)
-        query = Exercise.select() \
-            .where((Exercise.group_id == group) &
-                   (Exercise.guild_id == guild_id))
-
-        return [exercise.title for exercise in query]
+    def get_page_by_group(group_name: str, guild_id: int, after: int = None, limit: int = 10) -> list:
+        """Страница кортежей (id, название) заданий группы после задания after"""
+        query = (Exercise
+                 .select(Exercise.id, Exercise.title)
+                 .join(Groups)
+                 .where((Groups.group_name == group_name) &
+                        (Groups.guild_id == guild_id) &
+                        (Exercise.guild_id == guild_id)))
+        if after is not None:
+            query = query.where(Exercise.id > after)
+        return list(query.order_by(Exercise.id).limit(limit).tuples())
 
     @staticmethod
     def get_all(guild_id: int):
@@ -137,14 +206,88 @@ class ExerciseManager:
 class StudentManager:
 
     @staticmethod
-    def insert_list(students: list[tuple]):
+    def sync_group(group_name: str, guild_id: int, member_ids: list) -> tuple:
+        """Приводит состав группы к списку участников одной транзакцией
+
+        Возвращает количество добавленных, переведенных из другой группы, удаленных студентов
+        и оставленных в группе без роли: студенты со сданными работами не удаляются,
+        чтобы не терять историю сдачи.
+        """
+        members = set(member_ids)
+        with BaseModel.database.atomic():
+            group = GroupManager.get_by_name(group_name, guild_id)
+            existing = dict(Student
+                            .select(Student.member_id, Student.group_id)
+                            .where(Student.guild_id == guild_id)
+                            .tuples())
+            inserted = [member for member in members if member not in existing]
+            updated = [member for member in members if member in existing and existing[member] != group.id]
+
+            rows = [(member, group.id, guild_id) for member in inserted + updated]
+            for batch in chunked(rows, 300):
+                (Student
+                 .insert_many(batch, fields=[Student.member_id, Student.group_id, Student.guild_id])
+                 .on_conflict(conflict_target=[Student.member_id, Student.guild_id],
+                              update={Student.group_id: EXCLUDED.group_id})
+                 .execute())
+            for batch in chunked(updated, 300):
+                GradebookManager.refresh([student_id for student_id, in (Student
+                                                                         .select(Student.id)
+                                                                         .where((Student.guild_id == guild_id) &
+                                                                                (Student.member_id.in_(batch)))
+                                                                         .tuples())])
+
+            stale = [member for member, group_id in existing.items()
+                     if group_id == group.id and member not in members]
+            removed = 0
+            for batch in chunked(stale, 500):
+                removed += (Student
+                            .delete()
+                            .where((Student.guild_id == guild_id) &
+                                   (Student.member_id.in_(batch)) &
+                                   (Student.id.not_in(DoneExercises.select(DoneExercises.student))))
+                            .execute())
+        return len(inserted), len(updated), removed, len(stale) - removed
 
-        for student in students:
-            Student.get_or_create(
-                member_id=student[0],
-                group_id=GroupManager.get_by_name(student[1], student[2]),
-                guild_id=student[2]
-            )
+    @staticmethod
+    def apply_role_changes(changes: list) -> tuple:
+        """Применяет накопленные изменения ролей одной транзакцией
+
+        changes - кортежи (guild_id, member_id, group_id, joined). Вступившие в группу
+        добавляются или переводятся в нее, покинувшие удаляются, если у них нет сданных работ.
+        Возвращает количество добавленных или переведенных и удаленных студентов.
+        """
+        joined = [(member, group, guild) for guild, member, group, is_joined in changes if is_joined]
+        left = {}
+        for guild, member, group, is_joined in changes:
+            if not is_joined:
+                left.setdefault((guild, group), []).append(member)
+
+        removed = 0
+        with BaseModel.database.atomic():
+            for batch in chunked(joined, 300):
+                (Student
+                 .insert_many(batch, fields=[Student.member_id, Student.group_id, Student.guild_id])
+                 .on_conflict(conflict_target=[Student.member_id, Student.guild_id],
+                              update={Student.group_id: EXCLUDED.group_id})
+                 .execute())
+                members = {member for member, _, _ in batch}
+                guilds = {guild for _, _, guild in batch}
+                GradebookManager.refresh([student_id for student_id, in (Student
+                                                                         .select(Student.id)
+                                                                         .where((Student.guild_id.in_(guilds)) &
+                                                                                (Student.member_id.in_(members)))
+                                                                         .tuples())])
+            for (guild, group), members in left.items():
+                for batch in chunked(members, 500):
+                    removed += (Student
+                                .delete()
+                                .where((Student.guild_id == guild) &
+                                       (Student.group_id == group) &
+                                       (Student.member_id.in_(batch)) &
+                                       (Student.id.not_in(DoneExercises.select(DoneExercises.student))))
+                                .execute())
+        return len(joined), removed
 
     @staticmethod
     def insert(student: Student):
@@ -158,6 +301,19 @@ class StudentManager:
                                           (Student.group_id == group))
         return [student.member_id for student in students]
 
+    @staticmethod
+    def get_page_by_group(group_name: str, guild_id: int, after: int = None, limit: int = 10) -> list:
+        """Страница кортежей (id, member_id) студентов группы после студента after"""
+        query = (Student
+                 .select(Student.id, Student.member_id)
+                 .join(Groups)
+                 .where((Groups.group_name == group_name) &
+                        (Groups.guild_id == guild_id) &
+                        (Student.guild_id == guild_id)))
+        if after is not None:
+            query = query.where(Student.id > after)
+        return list(query.order_by(Student.id).limit(limit).tuples())
+
     @staticmethod
     def get_by_id(member_id: int, guild_id: int):
         try:
@@ -175,27 +331,335 @@ class DoneExerciseManager:
     @staticmethod
     def insert(done_exercise: DoneExercises):
         with BaseModel.database.atomic():
-            return done_exercise.save()
+            result = done_exercise.save()
+            GradebookManager.record(done_exercise)
+            return result
 
     @staticmethod
-    def get_by_student(member_id: int, guild_id: int):
-        student = StudentManager.get_by_id(member_id, guild_id)
-        try:
-            exercises = DoneExercises.select().where(DoneExercises.student == student)
-        except Exception as ex:
-            logger.exception(ex)
-        else:
-            return exercises
+    def get_by_student(member_id: int, guild_id: int) -> list:
+        """Пары (название задания, время сдачи) по работам студента одним запросом"""
+        query = (DoneExercises
+                 .select(Exercise.title, DoneExercises.done_at)
+                 .join(Exercise)
+                 .switch(DoneExercises)
+                 .join(Student)
+                 .where((Student.member_id == member_id) &
+                        (Student.guild_id == guild_id))
+                 .order_by(DoneExercises.id)
+                 .tuples())
+        return list(query)
 
     @staticmethod
     def get_by_exercise():
         pass
 
 
+class GradebookManager:
+    """ Класс GradebookManager ведет сводку сдачи работ
+
+    GradebookCell хранит по строке на пару (студент, задание), ExerciseProgress и StudentProgress -
+    число сдавших задание студентов его группы и число сданных студентом заданий своей группы.
+    Сводки обновляются при сдаче работы и при переводе студентов между группами,
+    поэтому журнал читается без агрегации по DoneExercises.
+
+    """
+
+    @staticmethod
+    def record(done_exercise: DoneExercises):
+        """Учитывает сданную работу; вызывается в транзакции DoneExerciseManager.insert"""
+        student, exercise = done_exercise.student, done_exercise.exercise
+        updated = (GradebookCell
+                   .update(attempts=GradebookCell.attempts + 1, last_done_at=done_exercise.done_at)
+                   .where((GradebookCell.student == student.id) &
+                          (GradebookCell.exercise == exercise.id))
+                   .execute())
+        if updated:
+            return
+
+        GradebookCell.insert(student=student.id, exercise=exercise.id, attempts=1,
+                             first_done_at=done_exercise.done_at,
+                             last_done_at=done_exercise.done_at).execute()
+        if student.group_id_id is not None and student.group_id_id == exercise.group_id_id:
+            (ExerciseProgress
+             .insert(exercise=exercise.id, submitted=1)
+             .on_conflict(conflict_target=[ExerciseProgress.exercise],
+                          update={ExerciseProgress.submitted: ExerciseProgress.submitted + 1})
+             .execute())
+            (StudentProgress
+             .insert(student=student.id, submitted=1)
+             .on_conflict(conflict_target=[StudentProgress.student],
+                          update={StudentProgress.submitted: StudentProgress.submitted + 1})
+             .execute())
+
+    @staticmethod
+    def _counted_cells():
+        return (GradebookCell
+                .select()
+                .join(Student)
+                .switch(GradebookCell)
+                .join(Exercise)
+                .where(Student.group_id == Exercise.group_id))
+
+    @staticmethod
+    def refresh(student_ids: list):
+        """Пересчитывает сводки студентов, сменивших группу, и заданий, которые они сдавали"""
+        for batch in chunked(student_ids, 300):
+            exercises = [exercise for exercise, in (GradebookCell
+                                                    .select(GradebookCell.exercise)
+                                                    .where(GradebookCell.student.in_(batch))
+                                                    .distinct()
+                                                    .tuples())]
+            StudentProgress.delete().where(StudentProgress.student.in_(batch)).execute()
+            StudentProgress.insert_from(
+                GradebookManager._counted_cells()
+                .select(GradebookCell.student, fn.COUNT(GradebookCell.id))
+                .where(GradebookCell.student.in_(batch))
+                .group_by(GradebookCell.student),
+                fields=[StudentProgress.student, StudentProgress.submitted]).execute()
+
+            for exercise_batch in chunked(exercises, 300):
+                ExerciseProgress.delete().where(ExerciseProgress.exercise.in_(exercise_batch)).execute()
+                ExerciseProgress.insert_from(
+                    GradebookManager._counted_cells()
+                    .select(GradebookCell.exercise, fn.COUNT(GradebookCell.id))
+                    .where(GradebookCell.exercise.in_(exercise_batch))
+                    .group_by(GradebookCell.exercise),
+                    fields=[ExerciseProgress.exercise, ExerciseProgress.submitted]).execute()
+
+    @staticmethod
+    def rebuild():
+        """Полностью строит сводки по DoneExercises"""
+        with BaseModel.database.atomic():
+            for model in (ExerciseProgress, StudentProgress, GradebookCell):
+                model.delete().execute()
+            GradebookCell.insert_from(
+                DoneExercises
+                .select(DoneExercises.student, DoneExercises.exercise, fn.COUNT(DoneExercises.id),
+                        fn.MIN(DoneExercises.done_at), fn.MAX(DoneExercises.done_at))
+                .group_by(DoneExercises.student, DoneExercises.exercise),
+                fields=[GradebookCell.student, GradebookCell.exercise, GradebookCell.attempts,
+                        GradebookCell.first_done_at, GradebookCell.last_done_at]).execute()
+            StudentProgress.insert_from(
+                GradebookManager._counted_cells()
+                .select(GradebookCell.student, fn.COUNT(GradebookCell.id))
+                .group_by(GradebookCell.student),
+                fields=[StudentProgress.student, StudentProgress.submitted]).execute()
+            ExerciseProgress.insert_from(
+                GradebookManager._counted_cells()
+                .select(GradebookCell.exercise, fn.COUNT(GradebookCell.id))
+                .group_by(GradebookCell.exercise),
+                fields=[ExerciseProgress.exercise, ExerciseProgress.submitted]).execute()
+
+    @staticmethod
+    def get_matrix(group_name: str, guild_id: int) -> tuple:
+        """Возвращает студентов группы, ее задания и множество сданных пар (студент, задание)
+
+        Студенты - кортежи (id, member_id, сдано), задания - (id, название, сдавших).
+        """
+        # одна читающая транзакция: три выборки видят один снимок БД
+        with BaseModel.database.atomic():
+            return GradebookManager._read_matrix(group_name, guild_id)
+
+    @staticmethod
+    def _read_matrix(group_name: str, guild_id: int) -> tuple:
+        group = GroupManager.get_by_name(group_name, guild_id)
+        students = list(Student
+                        .select(Student.id, Student.member_id, fn.COALESCE(StudentProgress.submitted, 0))
+                        .join(StudentProgress, JOIN.LEFT_OUTER, on=(StudentProgress.student == Student.id))
+                        .where((Student.guild_id == guild_id) & (Student.group_id == group.id))
+                        .order_by(Student.id)
+                        .tuples())
+        exercises = list(Exercise
+                         .select(Exercise.id, Exercise.title, fn.COALESCE(ExerciseProgress.submitted, 0))
+                         .join(ExerciseProgress, JOIN.LEFT_OUTER, on=(ExerciseProgress.exercise == Exercise.id))
+                         .where((Exercise.guild_id == guild_id) & (Exercise.group_id == group.id))
+                         .order_by(Exercise.id)
+                         .tuples())
+        cells = set(GradebookCell
+                    .select(GradebookCell.student, GradebookCell.exercise)
+                    .join(Student)
+                    .switch(GradebookCell)
+                    .join(Exercise)
+                    .where((Student.group_id == group.id) & (Exercise.group_id == group.id))
+                    .tuples())
+        return students, exercises, cells
+
+    @staticmethod
+    def get_missing(title: str, guild_id: int) -> list:
+        """ID участников группы задания, не сдавших его"""
+        exercise = Exercise.get((Exercise.title == title) & (Exercise.guild_id == guild_id))
+        query = (Student
+                 .select(Student.member_id)
+                 .where((Student.guild_id == guild_id) &
+                        (Student.group_id == exercise.group_id_id) &
+                        ~fn.EXISTS(GradebookCell
+                                   .select(GradebookCell.id)
+                                   .where((GradebookCell.student == Student.id) &
+                                          (GradebookCell.exercise == exercise.id))))
+                 .order_by(Student.id)
+                 .tuples())
+        return [member_id for member_id, in query]
+
+
+class ExportManager:
+    """ Класс ExportManager выгружает данные сервера в файл
+
+    Каждый метод строит запрос, читает его курсором .iterator() без кэширования строк
+    и передает в Export.write. Возвращает (файл, количество строк).
+
+    """
+
+    @staticmethod
+    def submissions(fmt: str, guild_id: int, group_name: str = None, title: str = None) -> tuple:
+        query = (DoneExercises
+                 .select(DoneExercises.id, Student.member_id, Groups.group_name, Exercise.title,
+                         DoneExercises.done_at, DoneExercises.student_result)
+                 .join(Student)
+                 .switch(DoneExercises)
+                 .join(Exercise)
+                 .join(Groups, JOIN.LEFT_OUTER)
+                 .where(Exercise.guild_id == guild_id))
+        if group_name is not None:
+            query = query.where(Groups.group_name == group_name)
+        if title is not None:
+            query = query.where(Exercise.title == title)
+        return Export.write(query.order_by(DoneExercises.id).tuples().iterator(),
+                            ("id", "member_id", "group", "exercise", "done_at", "result"), fmt)
+
+    @staticmethod
+    def students(fmt: str, guild_id: int, group_name: str = None) -> tuple:
+        query = (Student
+                 .select(Student.member_id, Groups.group_name, fn.COALESCE(StudentProgress.submitted, 0))
+                 .join(Groups, JOIN.LEFT_OUTER)
+                 .switch(Student)
+                 .join(StudentProgress, JOIN.LEFT_OUTER, on=(StudentProgress.student == Student.id))
+                 .where(Student.guild_id == guild_id))
+        if group_name is not None:
+            query = query.where(Groups.group_name == group_name)
+        return Export.write(query.order_by(Student.id).tuples().iterator(),
+                            ("member_id", "group", "submitted"), fmt)
+
+    @staticmethod
+    def gradebook(fmt: str, guild_id: int, group_name: str = None) -> tuple:
+        query = (GradebookCell
+                 .select(Student.member_id, Groups.group_name, Exercise.title, GradebookCell.attempts,
+                         GradebookCell.first_done_at, GradebookCell.last_done_at)
+                 .join(Student)
+                 .switch(GradebookCell)
+                 .join(Exercise)
+                 .join(Groups, JOIN.LEFT_OUTER)
+                 .where(Exercise.guild_id == guild_id))
+        if group_name is not None:
+            query = query.where(Groups.group_name == group_name)
+        return Export.write(query.order_by(GradebookCell.id).tuples().iterator(),
+                            ("member_id", "group", "exercise", "attempts", "first_done_at", "last_done_at"), fmt)
+
+
+def render_matrix(students: list, exercises: list, cells: set, name) -> list:
+    """Строки таблицы сдачи: студенты по строкам, номера заданий по столбцам"""
+    width = max(len(str(len(exercises))), 1) + 1
+    header = " " * 20 + "".join(f"{number:>{width}}" for number in range(1, len(exercises) + 1)) + "  итого"
+    lines = [header]
+    for student_id, member_id, submitted in students:
+        marks = "".join(f"{'+' if (student_id, exercise_id) in cells else '.':>{width}}"
+                        for exercise_id, _, _ in exercises)
+        lines.append(f"{name(member_id)[:19]:<20}{marks}  {submitted}/{len(exercises)}")
+    lines.append("")
+    for number, (_, title, submitted) in enumerate(exercises, 1):
+        lines.append(f"{number}. {title} -- сдали {submitted}/{len(students)}")
+    return lines
+
+
+def format_kept(kept: int) -> str:
+    """Приписка к отчету о синхронизации про студентов, оставленных в группе без роли"""
+    if not kept:
+        return ""
+    return f"\nОставлено без роли (есть сданные работы): **{kept}**"
+
+
 class Study(commands.Cog):
+    SYNC_DELAY = 2.0
 
     def __init__(self, bot):
         self.bot = bot
+        self.group_manager = AsyncManager(GroupManager, bot.db, writes=("insert", "delete", "set_auto_sync"))
+        self.exercise_manager = AsyncManager(ExerciseManager, bot.db, writes=("insert", "update"))
+        self.student_manager = AsyncManager(StudentManager, bot.db,
+                                            writes=("insert", "sync_group", "apply_role_changes"))
+        self.done_exercise_manager = AsyncManager(DoneExerciseManager, bot.db, batched=("insert",))
+        self.gradebook_manager = AsyncManager(GradebookManager, bot.db)
+        self.export_manager = AsyncManager(ExportManager, bot.db)
+        self.role_index = RoleIndex()
+        # (guild_id, id роли) -> id группы с автообновлением; по id, чтобы переименование роли не рвало связь
+        self.auto_sync = {}
+        # (guild_id, member_id, group_id) -> True при получении роли, False при снятии
+        self.pending_sync = {}
+        self.sync_task = None
+        bot.warm_up_if_ready(self)
+
+    async def warm_up(self):
+        for guild_id, group_name, group_id in await self.group_manager.get_auto_sync():
+            # группы хранятся по названию роли, id роли известен только по кэшу сервера
+            guild = self.bot.get_guild(guild_id)
+            role = utils.get(guild.roles, name=group_name) if guild is not None else None
+            if role is not None:
+                self.auto_sync[(guild_id, role.id)] = group_id
+
+    @commands.Cog.listener(name="on_member_update")
+    async def on_member_update(self, before: Member, after: Member):
+        if before.roles != after.roles:
+            added, removed = self.role_index.update(before, after)
+            if self.auto_sync:
+                roles = {role.id: role for role in before.roles + after.roles}
+                self.queue_sync(after, [roles[role_id] for role_id in removed], False)
+                self.queue_sync(after, [roles[role_id] for role_id in added], True)
+
+    @commands.Cog.listener(name="on_member_join")
+    async def on_member_join(self, member: Member):
+        self.role_index.add_member(member)
+
+    @commands.Cog.listener(name="on_member_remove")
+    async def on_member_remove(self, member: Member):
+        self.role_index.remove_member(member)
+        if self.auto_sync:
+            self.queue_sync(member, member.roles, False)
+
+    def queue_sync(self, member: Member, roles: list, joined: bool):
+        for role in roles:
+            group_id = self.auto_sync.get((member.guild.id, role.id))
+            if group_id is None:
+                continue
+            if joined:
+                # переход в группу отменяет ожидающие выходы из других групп, но не другие вступления
+                for key in [key for key, is_joined in self.pending_sync.items()
+                            if key[:2] == (member.guild.id, member.id) and not is_joined]:
+                    del self.pending_sync[key]
+            key = (member.guild.id, member.id, group_id)
+            # повторное событие переносится в конец: при нескольких вступлениях побеждает последнее
+            self.pending_sync.pop(key, None)
+            self.pending_sync[key] = joined
+        if self.pending_sync and self.sync_task is None:
+            self.sync_task = self.bot.loop.create_task(self.flush_sync())
+
+    async def flush_sync(self):
+        await asyncio.sleep(self.SYNC_DELAY)
+        changes = [(guild_id, member_id, group_id, joined)
+                   for (guild_id, member_id, group_id), joined in self.pending_sync.items()]
+        self.pending_sync = {}
+        self.sync_task = None
+        try:
+            await self.student_manager.apply_role_changes(changes)
+        except Exception:
+            traceback.print_exc()
+
+    @commands.Cog.listener(name="on_guild_role_delete")
+    async def on_guild_role_delete(self, role: Role):
+        self.role_index.remove_role(role.guild.id, role.id)
+        self.auto_sync.pop((role.guild.id, role.id), None)
+
+    @commands.Cog.listener(name="on_guild_remove")
+    async def on_guild_remove(self, guild):
+        self.role_index.remove_guild(guild.id)
 
     @commands.group(name="канал")
     @commands.has_permissions(manage_channels=True)
@@ -218,16 +682,22 @@ class Study(commands.Cog):
                 }
 
                 category = next(filter(lambda x: role.name == x.name, ctx.guild.categories), None)
+                bucket = ("guild_channels", ctx.guild.id)
 
                 if not category:
-                    category = await ctx.guild.create_category(name=role.name, overwrites=overwrites)
-
-                text_channel = await ctx.guild.create_text_channel(name=role.name,
-                                                                   overwrites=overwrites,
-                                                                   category=category)
-                voice_channel = await ctx.guild.create_voice_channel(name=role.name,
-                                                                     overwrites=overwrites,
-                                                                     category=category)
+                    category = await self.bot.rest.submit(
+                        bucket, lambda: ctx.guild.create_category(name=role.name, overwrites=overwrites),
+                        INTERACTIVE)
+
+                # один маршрут POST /guilds/{id}/channels и одна корзина: каналы создаются по очереди
+                await self.bot.rest.submit(
+                    bucket,
+                    lambda: ctx.guild.create_text_channel(name=role.name, overwrites=overwrites, category=category),
+                    INTERACTIVE)
+                await self.bot.rest.submit(
+                    bucket,
+                    lambda: ctx.guild.create_voice_channel(name=role.name, overwrites=overwrites, category=category),
+                    INTERACTIVE)
                 await ctx.send("Каналы и категория созданы!")
 
     @role_channel.command(name="удалить")
@@ -242,7 +712,9 @@ class Study(commands.Cog):
                     return chr(base + c)
                 emojis = [to_emoji(x) for x in range(3)]
                 message = await ctx.send("Удалить:\n1.Текстовый канал.\n2.Голосовой канал.\n3.Оба.")
-                await message.add_reaction(*emojis)
+                for emoji in emojis:
+                    self.bot.rest.schedule(("reactions", ctx.channel.id), lambda e=emoji: message.add_reaction(e),
+                                           INTERACTIVE)
 
     @commands.group(name="группа")
     @commands.guild_only()
@@ -258,19 +730,28 @@ class Study(commands.Cog):
         """Отображает список студентов данной группы"""
         if group_name is not None:
             try:
-                GroupManager.get_by_name(group_name, ctx.guild.id)
+                await self.group_manager.get_by_name(group_name, ctx.guild.id)
             except DoesNotExist:
                 await ctx.send("В таблице отсутствуют записи о такой группе")
             else:
-                students = StudentManager.get_by_group(group_name, ctx.guild.id)
-                if students:
-                    student_names = list(map(lambda x: ctx.guild.get_member(x), students))
-                    group_emb = [f"**{student[0] + 1}**.{student[1].nick}\n" for student in enumerate(student_names)]
-                    embed = Embed(title=" ", color=0x8080ff)
-                    embed.add_field(name=f"Список студентов группы \"{group_name}\"",
-                                    value=''.join(group_emb), inline=True)
-                    await ctx.send(embed=embed)
-                else:
+                def fetch_page(after, limit):
+                    return self.student_manager.get_page_by_group(group_name, ctx.guild.id, after, limit)
+
+                role = utils.get(ctx.guild.roles, name=group_name)
+                role_members = self.role_index.members(ctx.guild, role.id) if role is not None else frozenset()
+
+                def display_name(row):
+                    member = ctx.guild.get_member(row[1])
+                    if member is None:
+                        return f"<@{row[1]}> (покинул сервер)"
+                    if row[1] not in role_members:
+                        return f"{member.display_name} (без роли группы)"
+                    return member.display_name
+
+                render = BotEmbed.enumerated_page(lambda: Embed(title=" ", color=0x8080ff),
+                                                  f"Список студентов группы \"{group_name}\"", display_name)
+                paginator = KeysetPaginator(ctx, fetch_page, key=lambda row: row[0], render=render)
+                if not await paginator.start():
                     await ctx.send("В таблице отсутствуют записи о студентах этой группы")
         else:
             await ctx.send("Введите название группы!")
@@ -280,7 +761,7 @@ class Study(commands.Cog):
     async def create_group(self, ctx, *, group_name: str):
         """Добавляет группу в БД для дальнейшей работы"""
         try:
-            GroupManager.insert(group_name, ctx.guild.id)
+            await self.group_manager.insert(group_name, ctx.guild.id)
         except IntegrityError:
             await ctx.send("Ошибка записи в бд, попробуйте другое имя!")
         else:
@@ -291,12 +772,39 @@ class Study(commands.Cog):
     async def delete_group(self, ctx, *, group_name: str):
         """Удаляет группу из БД"""
         try:
-            GroupManager.delete(group_name, ctx.guild.id)
+            group_id = await self.group_manager.delete(group_name, ctx.guild.id)
         except DoesNotExist:
             await ctx.send("Ошибка удаления в бд, попробуйте другое имя!")
         else:
+            for key in [key for key, value in self.auto_sync.items() if value == group_id]:
+                del self.auto_sync[key]
             await ctx.send("Группа удалена!")
 
+    @groups.command(name="автообновление")
+    @commands.has_permissions(manage_roles=True)
+    async def toggle_auto_sync(self, ctx, state: str, *, group: Role):
+        """Включает (вкл) или выключает (выкл) обновление студентов группы при выдаче и снятии ее роли"""
+        if state not in ("вкл", "выкл"):
+            await ctx.send("Укажите \"вкл\" или \"выкл\" перед названием группы")
+            return
+        enabled = state == "вкл"
+        try:
+            group_id = await self.group_manager.set_auto_sync(group.name, ctx.guild.id, enabled)
+        except DoesNotExist:
+            await ctx.send("В таблице отсутствуют записи о такой группе")
+            return
+
+        if not enabled:
+            self.auto_sync.pop((ctx.guild.id, group.id), None)
+            await ctx.send("Автообновление группы выключено")
+            return
+
+        inserted, updated, removed, kept = await self.student_manager.sync_group(
+            group.name, ctx.guild.id, list(self.role_index.members(ctx.guild, group.id)))
+        self.auto_sync[(ctx.guild.id, group.id)] = group_id
+        await ctx.send(f"Автообновление группы включено. Добавлено: **{inserted}**, "
+                       f"переведено: **{updated}**, удалено: **{removed}**" + format_kept(kept))
+
     @groups.command(name="обновить")
     @commands.has_permissions(manage_roles=True)
     async def update_groups(self, ctx, *, group: Role = None):
@@ -306,24 +814,26 @@ class Study(commands.Cog):
             return ctx.channel == msg.channel and msg.author == ctx.author
 
         if group is not None:
-            students = list(filter(lambda x: group in x.roles, ctx.guild.members))
-            students_data = ((member.id,
-                              group.name,
-                              ctx.guild.id
-                              ) for member in students)
-            StudentManager.insert_list(students_data)
-            await ctx.send("Таблица студентов обновлена!")
+            students = list(self.role_index.members(ctx.guild, group.id))
+            try:
+                inserted, updated, removed, kept = await self.student_manager.sync_group(group.name, ctx.guild.id,
+                                                                                         students)
+            except DoesNotExist:
+                await ctx.send("В таблице отсутствуют записи о такой группе")
+            else:
+                await ctx.send(f"Таблица студентов обновлена! Добавлено: **{inserted}**, "
+                               f"переведено: **{updated}**, удалено: **{removed}**" + format_kept(kept))
 
     @groups.command(name="список")
     async def list_groups(self, ctx):
         """Отображает список групп, занесенных в БД"""
-        groups_list = GroupManager.get_with_count(ctx.guild.id)
-        if groups_list:
-            group_emb = [f"**{group[0]}**, количество студентов: **{group[1]}**\n" for group in groups_list]
-            embed = Embed(title=" ", color=0x8080ff)
-            embed.add_field(name="Список групп", value=''.join(group_emb), inline=True)
-            await ctx.send(embed=embed)
-        else:
+        def fetch_page(after, limit):
+            return self.group_manager.get_page_with_count(ctx.guild.id, after, limit)
+
+        render = BotEmbed.enumerated_page(lambda: Embed(title=" ", color=0x8080ff), "Список групп",
+                                          lambda row: f"**{row[0]}**, количество студентов: **{row[1]}**")
+        paginator = KeysetPaginator(ctx, fetch_page, key=lambda row: row[0], render=render)
+        if not await paginator.start():
             await ctx.send("Группы на этом сервере отсутствуют")
 
     @commands.group(name="работы")
@@ -337,15 +847,15 @@ class Study(commands.Cog):
     @tasks.command(name="мои")
     async def my_tasks(self, ctx):
         """Вывод списка всех выданных и отправленных студентом работ"""
-        exercises = ExerciseManager.get_by_student(ctx.author.id, ctx.guild.id)
-        done_exercises = DoneExerciseManager.get_by_student(ctx.author.id, ctx.guild.id)
+        exercises = await self.exercise_manager.get_by_student(ctx.author.id, ctx.guild.id)
+        done_exercises = await self.done_exercise_manager.get_by_student(ctx.author.id, ctx.guild.id)
         embed = Embed(title=f"Студент {ctx.author.nick}", color=0x8080ff)
         if exercises:
-            exercises_emb = [f"**{i[0] + 1}**. {i[1].title}\n" for i in enumerate(exercises)]
+            exercises_emb = [f"**{i[0] + 1}**. {i[1]}\n" for i in enumerate(exercises)]
             embed.add_field(name=f"Список всех заданий ",
                             value=''.join(exercises_emb), inline=True)
         if done_exercises:
-            done_emb = [f"**{i[0] + 1}**. {i[1].exercise.title} -- отправлено\n" for i in
+            done_emb = [f"**{i[0] + 1}**. {i[1][0]} -- отправлено\n" for i in
                         enumerate(done_exercises)]
             embed.add_field(name=f"Список сданных заданий",
                             value=''.join(done_emb), inline=True)
@@ -362,21 +872,21 @@ class Study(commands.Cog):
         def check(msg):
             return ctx.channel == msg.channel and msg.author == ctx.author
 
-        student = StudentManager.get_by_id(ctx.author.id, ctx.guild.id)
+        student = await self.student_manager.get_by_id(ctx.author.id, ctx.guild.id)
         if student:
             await ctx.send("Введите название задания, которое собираетесь сдать:")
             exercise_name = await self.bot.wait_for('message', check=check)
-            exercise = ExerciseManager.get_by_name(exercise_name.content, ctx.guild.id)
-            if exercise:
+            exercises = await self.exercise_manager.get_by_name(exercise_name.content, ctx.guild.id)
+            if exercises:
                 await ctx.send("Введите результат работы:")
                 student_result = await self.bot.wait_for('message', check=check)
                 done_exercise = DoneExercises(
                     student=student,
-                    exercise=exercise,
+                    exercise=exercises[0],
                     done_at=datetime.now(),
                     student_result=student_result.content
                 )
-                DoneExerciseManager.insert(done_exercise)
+                await self.done_exercise_manager.insert(done_exercise)
                 await ctx.send("Результат внесен")
             else:
                 await ctx.send("Ошибка в имени задания, попробуйте другое")
@@ -404,11 +914,12 @@ class Study(commands.Cog):
         title = await self.bot.wait_for('message', check=check)
         await ctx.send("Введите содержимое задания:")
         raw_content = await self.bot.wait_for('message', check=check)
-        if ExerciseManager.insert(Exercise(
+        group = await self.group_manager.get_by_name(group_id.content, ctx.guild.id)
+        if await self.exercise_manager.insert(Exercise(
                 title=title.content,
                 content=raw_content.content,
                 created_at=datetime.now(),
-                group_id=GroupManager.get_by_name(group_id.content, ctx.guild.id),
+                group_id=group,
                 guild_id=ctx.guild.id
         )):
             await ctx.send("Задание записано!")
@@ -418,13 +929,13 @@ class Study(commands.Cog):
     @commands.has_permissions(manage_messages=True)
     @exercise.command(name="группа")
     async def group_exercises(self, ctx, *, group_name: str):
-        exercises = ExerciseManager.get_all_by_group(group_name, ctx.guild.id)
-        if exercises:
-            tags_emb = [f"**{i[0] + 1}**. {i[1]}\n" for i in enumerate(exercises)]
-            embed = Embed(title="", color=0x8080ff)
-            embed.add_field(name=f"Список заданий группы {group_name}", value=''.join(tags_emb), inline=True)
-            await ctx.send(embed=embed)
-        else:
+        def fetch_page(after, limit):
+            return self.exercise_manager.get_page_by_group(group_name, ctx.guild.id, after, limit)
+
+        render = BotEmbed.enumerated_page(lambda: Embed(title="", color=0x8080ff),
+                                          f"Список заданий группы {group_name}", lambda row: row[1])
+        paginator = KeysetPaginator(ctx, fetch_page, key=lambda row: row[0], render=render)
+        if not await paginator.start():
             await ctx.send(f"Заданий для группы {group_name} нет")
 
     @commands.has_permissions(manage_messages=True)
@@ -432,11 +943,11 @@ class Study(commands.Cog):
     async def group_exercises(self, ctx, *, student: Member = None):
 
         if student is not None:
-            done_exercises = DoneExerciseManager.get_by_student(student.id, ctx.guild.id)
+            done_exercises = await self.done_exercise_manager.get_by_student(student.id, ctx.guild.id)
             if done_exercises:
                 embed = Embed(title=f"Студент {student.nick}", color=0x8080ff)
 
-                done_emb = [f"**{i[0] + 1}**. {i[1].exercise.title} -- отправлено\n" for i in
+                done_emb = [f"**{i[0] + 1}**. {i[1][0]} -- отправлено\n" for i in
                             enumerate(done_exercises)]
                 embed.add_field(name=f"Список сданных заданий",
                                 value=''.join(done_emb), inline=True)
@@ -444,6 +955,111 @@ class Study(commands.Cog):
             else:
                 await ctx.send(f"У студента {student.nick} нет сданных работ")
 
+    @commands.group(name="журнал")
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def gradebook(self, ctx):
+        """Сводка сдачи работ для преподавателя"""
+        if ctx.invoked_subcommand is None:
+            await ctx.send("Введите аргументы для команды: \"группа\" или \"несдавшие\"")
+
+    @gradebook.command(name="группа")
+    async def gradebook_group(self, ctx, *, group_name: str):
+        """Отображает таблицу сдачи заданий студентами группы"""
+        try:
+            students, exercises, cells = await self.gradebook_manager.get_matrix(group_name, ctx.guild.id)
+        except DoesNotExist:
+            await ctx.send("В таблице отсутствуют записи о такой группе")
+            return
+        if not students or not exercises:
+            await ctx.send(f"В группе {group_name} нет студентов или заданий")
+            return
+
+        def name(member_id):
+            member = ctx.guild.get_member(member_id)
+            return member.display_name if member is not None else str(member_id)
+
+        chunk = []
+        size = 0
+        for line in render_matrix(students, exercises, cells, name):
+            if size + len(line) + 1 > 1900:
+                await ctx.send("```\n" + "\n".join(chunk) + "```")
+                chunk, size = [], 0
+            chunk.append(line)
+            size += len(line) + 1
+        await ctx.send("```\n" + "\n".join(chunk) + "```")
+
+    @gradebook.command(name="несдавшие")
+    async def gradebook_missing(self, ctx, *, title: str):
+        """Отображает студентов группы, не сдавших задание"""
+        try:
+            members = await self.gradebook_manager.get_missing(title, ctx.guild.id)
+        except DoesNotExist:
+            await ctx.send("Ошибка в имени задания, попробуйте другое")
+            return
+        if not members:
+            await ctx.send(f"Задание {title} сдали все студенты группы")
+            return
+
+        embed = Embed(title=f"Не сдали задание \"{title}\"", color=0x8080ff)
+        description = ""
+        for number, member_id in enumerate(members, 1):
+            line = f"**{number}**. <@{member_id}>\n"
+            if len(description) + len(line) > 4096:
+                break
+            description += line
+        embed.description = description
+        embed.set_footer(text=f"Всего: {len(members)}")
+        await ctx.send(embed=embed)
+
+    @commands.group(name="экспорт")
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def export(self, ctx):
+        """Выгружает данные сервера файлом в формате csv, jsonl, csv.gz или jsonl.gz"""
+        if ctx.invoked_subcommand is None:
+            await ctx.send("Введите аргументы для команды: \"работы\", \"задание\", \"студенты\" или \"журнал\". "
+                           "Например: экспорт работы csv <группа>")
+
+    async def send_export(self, ctx, name: str, fmt: str, method, *args):
+        if fmt not in Export.FORMATS:
+            await ctx.send(f"Поддерживаемые форматы: {', '.join(Export.FORMATS)}")
+            return
+        file, count = await method(fmt, ctx.guild.id, *args)
+        try:
+            if not count:
+                await ctx.send("Нет данных для выгрузки")
+                return
+            size = file.seek(0, 2)
+            file.seek(0)
+            if size > ctx.guild.filesize_limit:
+                await ctx.send(f"Файл ({size // 1024} КБ) больше допустимого размера вложения, "
+                               f"выберите формат {fmt.split('.')[0]}.gz или выгрузите одну группу")
+                return
+            await ctx.send(f"Строк: **{count}**", file=File(file, filename=f"{name}_{ctx.guild.id}.{fmt}"))
+        finally:
+            file.close()
+
+    @export.command(name="работы")
+    async def export_submissions(self, ctx, fmt: str = "csv", *, group_name: str = None):
+        """Сданные работы сервера или группы"""
+        await self.send_export(ctx, "submissions", fmt, self.export_manager.submissions, group_name)
+
+    @export.command(name="задание")
+    async def export_exercise(self, ctx, fmt: str, *, title: str):
+        """Сданные работы по одному заданию"""
+        await self.send_export(ctx, "exercise", fmt, self.export_manager.submissions, None, title)
+
+    @export.command(name="студенты")
+    async def export_students(self, ctx, fmt: str = "csv", *, group_name: str = None):
+        """Студенты сервера или группы с количеством сданных работ"""
+        await self.send_export(ctx, "students", fmt, self.export_manager.students, group_name)
+
+    @export.command(name="журнал")
+    async def export_gradebook(self, ctx, fmt: str = "csv", *, group_name: str = None):
+        """Сводка сдачи: строка на каждую пару студент - задание"""
+        await self.send_export(ctx, "gradebook", fmt, self.export_manager.gradebook, group_name)
+
 
 def setup(bot):
     bot.add_cog(Study(bot))
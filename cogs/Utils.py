@@ -1,7 +1,11 @@
 from discord.ext import commands
+import asyncio
+import traceback
 import discord
 from Utilities import BaseModel
-from playhouse.sqlite_ext import *
+from Utilities.AsyncDatabase import AsyncManager
+from peewee import DoesNotExist, IntegerField, TextField
+from playhouse.sqlite_ext import AutoIncrementField
 
 
 class MemberRoles(commands.MemberConverter):
@@ -14,9 +18,35 @@ class RoleMessages(BaseModel.BaseModel):
     id = AutoIncrementField(primary_key=True)
     message_id = IntegerField(null=False)
     role = TextField(null=False)
+    role_id = IntegerField(null=True)
     guild_id = IntegerField(null=False)
 
 
+class GuildPrefix(BaseModel.BaseModel):
+    id = AutoIncrementField(primary_key=True)
+    guild_id = IntegerField(null=False, unique=True)
+    prefix = TextField(null=False)
+
+
+class PrefixManager:
+
+    @staticmethod
+    def get_all() -> dict:
+        """Словарь guild_id -> префикс для всех серверов с собственным префиксом"""
+        return dict(GuildPrefix.select(GuildPrefix.guild_id, GuildPrefix.prefix).tuples())
+
+    @staticmethod
+    def set_prefix(guild_id: int, prefix: str):
+        return (GuildPrefix
+                .insert(guild_id=guild_id, prefix=prefix)
+                .on_conflict(conflict_target=[GuildPrefix.guild_id], update={GuildPrefix.prefix: prefix})
+                .execute())
+
+    @staticmethod
+    def reset_prefix(guild_id: int):
+        return GuildPrefix.delete().where(GuildPrefix.guild_id == guild_id).execute()
+
+
 class RoleMessagesManager:
 
     @staticmethod
@@ -42,16 +72,49 @@ class RoleMessagesManager:
         return RoleMessages.select()
 
     @staticmethod
-    def init_db():
-        BaseModel.database.connect()
-        BaseModel.database.create_tables(RoleMessages, safe=True)
-        BaseModel.database.close()
+    def set_role_ids(role_ids: dict):
+        with BaseModel.database.atomic():
+            for message_id, role_id in role_ids.items():
+                RoleMessages.update(role_id=role_id).where(RoleMessages.id == message_id).execute()
 
 
 class Utils(commands.Cog):
+    GRANT_DELAY = 1.0
+    MAX_PREFIX_LENGTH = 10
+
     def __init__(self, bot):
         self.bot = bot
-        self.messages = []
+        self.role_messages_manager = AsyncManager(RoleMessagesManager, bot.db, batched=("insert",),
+                                                 writes=("set_role_ids",))
+        self.prefix_manager = AsyncManager(PrefixManager, bot.db, writes=("set_prefix", "reset_prefix"))
+        # (guild_id, message_id) -> role_id
+        self.role_messages = {}
+        # (guild_id, member_id) -> множество role_id, ожидающих выдачи одним запросом
+        self.pending_grants = {}
+        bot.warm_up_if_ready(self)
+
+    @commands.command(name="префикс")
+    @commands.guild_only()
+    async def guild_prefix(self, ctx, *, prefix: str = None):
+        """Показывает префикс команд сервера, меняет его или возвращает стандартный аргументом \"сброс\""""
+        if prefix is None:
+            prefix = self.bot.prefixes.get(ctx.guild.id, self.bot.default_prefix)
+            await ctx.send(f"Префикс команд на сервере: **{prefix}**")
+            return
+        if not ctx.author.guild_permissions.manage_guild and not await self.bot.is_owner(ctx.author):
+            await ctx.send("Менять префикс может только администратор сервера")
+            return
+
+        if prefix == "сброс":
+            await self.prefix_manager.reset_prefix(ctx.guild.id)
+            self.bot.prefixes.pop(ctx.guild.id, None)
+            await ctx.send(f"Префикс сброшен на стандартный: **{self.bot.default_prefix}**")
+        elif len(prefix) > self.MAX_PREFIX_LENGTH or any(char.isspace() for char in prefix):
+            await ctx.send(f"Префикс должен быть без пробелов и не длиннее {self.MAX_PREFIX_LENGTH} символов")
+        else:
+            await self.prefix_manager.set_prefix(ctx.guild.id, prefix)
+            self.bot.prefixes[ctx.guild.id] = prefix
+            await ctx.send(f"Новый префикс команд: **{prefix}**")
 
     @commands.command(name="роли")
     @commands.guild_only()
@@ -66,7 +129,7 @@ class Utils(commands.Cog):
 
         converter = commands.RoleConverter()
         try:
-            await converter.convert(ctx=ctx, argument=role)
+            guild_role = await converter.convert(ctx=ctx, argument=role)
         except commands.RoleNotFound:
             await ctx.send(f"Роли {role} нет на данном сервере, хотите создать такую?(+/-)")
             answer = await self.bot.wait_for("message", check=check)
@@ -95,29 +158,55 @@ class Utils(commands.Cog):
                                      f"Отреагируйте любым эмодзи**")
             message = RoleMessages(
                 message_id=message.id,
-                role=role,
+                role=guild_role.name,
+                role_id=guild_role.id,
                 guild_id=ctx.guild.id
             )
-            RoleMessagesManager.insert(message)
-            self.messages.append(message)
-
-    @commands.Cog.listener(name="on_ready")
-    async def on_ready(self):
-        for message in RoleMessagesManager.get_all():
-            self.messages.append(message)
+            await self.role_messages_manager.insert(message)
+            self.role_messages[(message.guild_id, message.message_id)] = guild_role.id
+
+    async def warm_up(self):
+        resolved = {}
+        for message in await self.role_messages_manager.get_all():
+            role_id = message.role_id
+            if role_id is None:
+                guild = self.bot.get_guild(message.guild_id)
+                role = guild and discord.utils.get(guild.roles, name=message.role)
+                if role is None:
+                    continue
+                role_id = resolved[message.id] = role.id
+            self.role_messages[(message.guild_id, message.message_id)] = role_id
+        if resolved:
+            await self.role_messages_manager.set_role_ids(resolved)
 
     @commands.Cog.listener(name="on_raw_reaction_add")
     async def on_raw_reaction_add(self, reaction_data: discord.RawReactionActionEvent):
-        # message = RoleMessagesManager.get_by_id(reaction_data.message_id,
-        #                                         reaction_data.guild_id)
-        def check_message(user_message):
-            return reaction_data.message_id == user_message.message_id and \
-                   reaction_data.guild_id == user_message.guild_id
-
-        message = list(filter(check_message, self.messages))
-        if message:
-            role = discord.utils.get(reaction_data.member.guild.roles, name=message[0].role)
-            await reaction_data.member.add_roles(role)
+        role_id = self.role_messages.get((reaction_data.guild_id, reaction_data.message_id))
+        if role_id is None:
+            return
+        member = reaction_data.member
+        if member is None or member.bot:
+            return
+
+        key = (member.guild.id, member.id)
+        pending = self.pending_grants.get(key)
+        if pending is not None:
+            pending.add(role_id)
+        else:
+            self.pending_grants[key] = {role_id}
+            self.bot.loop.create_task(self.grant_roles(member, key))
+
+    async def grant_roles(self, member: discord.Member, key: tuple):
+        await asyncio.sleep(self.GRANT_DELAY)
+        role_ids = self.pending_grants.pop(key, set())
+        held = {role.id for role in member.roles}
+        roles = [member.guild.get_role(role_id) for role_id in role_ids - held]
+        roles = [role for role in roles if role is not None]
+        if roles:
+            try:
+                await self.bot.rest.submit(("member_roles", member.guild.id), lambda: member.add_roles(*roles))
+            except discord.HTTPException:
+                traceback.print_exc()
 
 
 def setup(bot):
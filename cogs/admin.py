@@ -40,6 +40,28 @@ class Admin(commands.Cog):
         else:
             await ctx.send('\N{OK HAND SIGN}')
 
+    @commands.command(name="статистика", hidden=True)
+    async def stats(self, ctx):
+        """Выводит состояние очередей запросов к БД и к Discord"""
+        rest = self.bot.rest.stats()
+        db = self.bot.db.stats()
+        lines = [
+            f"БД: в очереди **{db['pending']}**, групповых коммитов **{db['batches']}**, "
+            f"записей в них **{db['batched_writes']}**",
+        ]
+        for name, title in (("read", f"чтения ({db['readers']} потоков)"), ("write", "записи (1 поток)")):
+            pool = db[name]
+            lines.append(f"{title}: выполнено **{pool['calls']}**, ожидание в среднем "
+                         f"**{pool['wait_avg'] * 1000:.1f} мс**, максимум **{pool['wait_max'] * 1000:.0f} мс**, "
+                         f"выполнение **{pool['run_avg'] * 1000:.1f} мс**, занято **{pool['busy']}** "
+                         f"(пик **{pool['busy_max']}**)")
+        lines.append(f"Discord: в очереди **{rest['depth']}**, активных корзин **{rest['buckets']}**")
+        for name, title in (("interactive", "интерактивные"), ("background", "фоновые")):
+            count, average, maximum = rest[name]
+            lines.append(f"{title}: выполнено **{count}**, ожидание в среднем **{average * 1000:.0f} мс**, "
+                         f"максимум **{maximum * 1000:.0f} мс**")
+        await ctx.send("\n".join(lines))
+
     @commands.command(name="очистить")
     @commands.is_owner()
     async def clear_messages(self, ctx, mgs_count: int):
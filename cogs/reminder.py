@@ -1,11 +1,17 @@
+import asyncio
 import datetime
+import sys
+import traceback
 from datetime import datetime, timedelta
 
-from discord import Embed
-from discord.ext import commands, tasks
-from playhouse.sqlite_ext import *
+from discord import Embed, Forbidden, NotFound
+from discord.ext import commands
+from peewee import DateTimeField, IntegerField, TextField, chunked
 
-from Utilities import BaseModel
+from Utilities import BaseModel, TimeParser
+from Utilities.AsyncDatabase import AsyncManager
+from Utilities.Paginator import KeysetPaginator
+from Utilities.Scheduler import TimerScheduler
 
 
 class Reminders(BaseModel.BaseModel):
@@ -25,11 +31,34 @@ class ReminderManager:
         return list(query)
 
     @staticmethod
-    def get_by_author(author: int) -> dict:
-        query = Reminders.select().where(Reminders.author_id == author)
-        reasons = [rem.reason for rem in query]
-        end_time = [rem.ended_at for rem in query]
-        return dict(zip(reasons, end_time))
+    def get_due(until: datetime, after: datetime = None) -> list:
+        """Возвращает напоминания со сроком в интервале (after, until] по возрастанию срока"""
+        query = Reminders.select().where(Reminders.ended_at <= until)
+        if after is not None:
+            query = query.where(Reminders.ended_at > after)
+        return list(query.order_by(Reminders.ended_at))
+
+    @staticmethod
+    def get_by_author(author: int, after: tuple = None, limit: int = 10) -> list:
+        """Возвращает страницу напоминаний автора кортежами (id, ended_at, reason)
+
+        Страницы упорядочены по (ended_at, id); after - курсор (ended_at, id)
+        последнего напоминания предыдущей страницы.
+        """
+        query = (Reminders
+                 .select(Reminders.id, Reminders.ended_at, Reminders.reason)
+                 .where(Reminders.author_id == author))
+        if after is not None:
+            query = query.where((Reminders.ended_at > after[0]) |
+                                ((Reminders.ended_at == after[0]) & (Reminders.id > after[1])))
+        return list(query.order_by(Reminders.ended_at, Reminders.id).limit(limit).tuples())
+
+    @staticmethod
+    def delete_by_author(reminder_id: int, author: int) -> int:
+        return (Reminders
+                .delete()
+                .where((Reminders.id == reminder_id) & (Reminders.author_id == author))
+                .execute())
 
     @staticmethod
     def insert_reminder(reminder: Reminders):
@@ -41,74 +70,92 @@ class ReminderManager:
         return reminder.delete_instance()
 
     @staticmethod
-    def init_db():
-        BaseModel.database.connect()
-        BaseModel.database.create_tables(Reminders)
-        BaseModel.database.close()
-
-
-def string_to_date(string_to_parse: str) -> datetime:
-    regex_delta_absolute = r"\b(?:в|на) (\d\d:\d\d|\d?(?: вечера| утра| ночи)?)\b"
-    regex_delta_relative = r"\bчерез (\d{1,3}) (минут\w?|час\w?\w?|секунд\w?)\b"
-    match = re.fullmatch(regex_delta_relative, string_to_parse)
-    if not match:
-        return False
-    elif re.fullmatch(regex_delta_relative, string_to_parse):
-        return get_relative_delta(count=match[1], unit=match[2])
-    elif re.fullmatch(regex_delta_absolute, string_to_parse):
-        match = re.fullmatch(regex_delta_absolute, string_to_parse)
-        return get_absolute_delta(string_to_parse)
-
-
-def get_relative_delta(unit, count):
-    reminder_date = datetime.now()
-
-    if re.fullmatch(r"\bминут\w?\b", unit):
+    def delete_many(reminder_ids: list):
+        # частями, чтобы не упереться в лимит переменных SQLite на больших пачках
+        deleted = 0
+        with BaseModel.database.atomic():
+            for batch in chunked(reminder_ids, 500):
+                deleted += Reminders.delete().where(Reminders.id.in_(batch)).execute()
+        return deleted
 
-        delta = timedelta(days=0, hours=0, minutes=float(count))
-        return reminder_date + delta
-    elif re.fullmatch(r"\bчас\w?\w?\b", unit):
 
-        delta = timedelta(days=0, hours=float(count), minutes=0)
-        return reminder_date + delta
-    elif re.fullmatch(r"\bсекунд\w?\b", unit):
+def format_reminders(reminders: list) -> str:
+    if len(reminders) == 1:
+        return f"<@{reminders[0].author_id}>, напоминаю вам: {reminders[0].reason}"
+    return "Напоминаю:" + ''.join(f"\n<@{reminder.author_id}>: {reminder.reason}" for reminder in reminders)
 
-        delta = timedelta(days=0, hours=0, minutes=0, seconds=float(count))
-        return reminder_date + delta
-    else:
-        return reminder_date
 
+def split_message(text: str, limit: int = 2000) -> list:
+    """Делит текст на сообщения не длиннее limit символов, по возможности по строкам"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
 
-def get_absolute_delta(date_string):
-    regex_delta_absolute = r"\b(?:в|на) (\d\d:\d\d|(\d)?( вечера| утра| ночи)?)\b"
-    match = re.fullmatch(regex_delta_absolute, date_string)
-    if re.fullmatch(r"\bв (\d\d:\d\d)\b", date_string):
-        pass
-    elif re.fullmatch(r"\b(?:в|на) (\d)?( вечера| утра| ночи)?\b", date_string):
-        pass
 
-    print(f"match 0 -- {match[1]}\nmatch 1 -- {match[2]}\nmatch 3 -- {match[3]}")
+class Reminder(commands.Cog):
+    """Напоминания
 
+    В памяти планировщика держатся только напоминания со сроком до loaded_until,
+    более дальние подгружаются из БД по мере приближения окна.
+    Напоминания, пропущенные за время простоя бота, обрабатываются по политике
+    reminder_missed_policy из конфигурации:
+        fire - отправить каждое сразу;
+        coalesce - отправить пропущенные одним сообщением на автора и канал;
+        drop - удалить просроченные более чем на reminder_drop_after_hours часов, остальные отправить.
+    """
 
-class Reminder(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.reminders = ReminderManager.get_all_reminders()
-        self.check_reminders.start()
-
+        self.reminder_manager = AsyncManager(ReminderManager, bot.db, batched=("insert_reminder",),
+                                             writes=("delete_by_author", "delete_many", "delete_reminder"))
+        self.scheduler = TimerScheduler(self.fire_reminders)
+        self.window = timedelta(minutes=bot.config.get('reminder_window_minutes', 60))
+        self.missed_policy = bot.config.get('reminder_missed_policy', 'fire')
+        self.drop_after = timedelta(hours=bot.config.get('reminder_drop_after_hours', 24))
+        self.max_attempts = bot.config.get('reminder_max_attempts', 5)
+        self.delivery_slots = asyncio.Semaphore(bot.config.get('reminder_delivery_concurrency', 8))
+        self.attempts = {}
+        self.loaded_until = None
+        # фоновые задачи доставки; ссылки не дают сборщику мусора удалить их до завершения
+        self.tasks = set()
+        self.scheduler_task = bot.loop.create_task(self.run_scheduler())
+        bot.warm_up_if_ready(self)
+
+    def cog_unload(self):
+        self.scheduler_task.cancel()
+
+    def spawn(self, coroutine):
+        """Запускает фоновую задачу, храня ссылку на нее до завершения и печатая ее ошибку"""
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            traceback.print_exception(type(error), error, error.__traceback__)
 
     @commands.command(name="напомни")
     @commands.guild_only()
     async def remind(self, ctx, *args):
-        """Создает напоминание на указаное время в формате "через n минут/часов/секунд"
+        """Создает напоминание на указаное время в формате "через 1 час 30 минут", "в 18:00",
+        "завтра в 7 вечера" или "25.12 в 9:00"
         """
         def check(msg):
             return ctx.channel == msg.channel and msg.author == ctx.author
 
         try:
-            ended_date = string_to_date(' '.join(args))
-        except Exception as e:
-            print(e)
+            ended_date = TimeParser.parse(' '.join(args))
+        except TimeParser.TimeParseError as error:
+            await ctx.send(error.message)
         else:
             await ctx.send("Введите что именно вам напомнить: ")
             raw_content = await self.bot.wait_for('message', check=check)
@@ -119,42 +166,168 @@ class Reminder(commands.Cog):
                 author_id=ctx.author.id,
                 channel_id=ctx.channel.id
             )
-            ReminderManager.insert_reminder(reminder)
-            self.reminders.append(reminder)
+            await self.reminder_manager.insert_reminder(reminder)
+            if self.loaded_until is not None and reminder.ended_at <= self.loaded_until:
+                self.scheduler.schedule(reminder.id, reminder.ended_at, reminder)
             await ctx.send("Напоминание записано!")
 
-    @commands.command(name="напоминания")
+    @commands.group(name="напоминания", invoke_without_command=True)
     @commands.guild_only()
     async def my_reminders(self, ctx):
         """
-        Выводит все ваши актуальные напоминания
+        Выводит все ваши актуальные напоминания постранично
+        """
+        def fetch_page(after, limit):
+            return self.reminder_manager.get_by_author(ctx.author.id, after, limit)
+
+        def render(rows, page):
+            embed = Embed(title=f"{ctx.author.display_name} напоминания", color=0x8080ff)
+            for reminder_id, ended_at, reason in rows:
+                embed.add_field(name=f"#{reminder_id} — {ended_at:%Y-%m-%d %H:%M:%S}",
+                                value=reason[:1024],
+                                inline=False)
+            embed.set_footer(text=f"Страница {page + 1}. Отменить: {ctx.prefix}напоминания отменить <номер>")
+            return embed
+
+        paginator = KeysetPaginator(ctx, fetch_page, key=lambda row: (row[1], row[0]), render=render)
+        if not await paginator.start():
+            await ctx.send("У вас нет напоминаний")
+
+    @my_reminders.command(name="отменить")
+    async def cancel_reminder(self, ctx, reminder_id: int):
+        """Отменяет ваше напоминание по номеру из списка напоминаний"""
+        if await self.reminder_manager.delete_by_author(reminder_id, ctx.author.id):
+            self.scheduler.cancel(reminder_id)
+            self.attempts.pop(reminder_id, None)
+            await ctx.send("Напоминание отменено")
+        else:
+            await ctx.send("У вас нет напоминания с таким номером")
+
+    async def warm_up(self):
+        await self.recover_missed()
+
+    async def run_scheduler(self):
+        await self.bot.wait_until_warm()
+        scheduler = asyncio.ensure_future(self.scheduler.run())
+        try:
+            while True:
+                await asyncio.sleep(self.window.total_seconds() / 2)
+                try:
+                    await self.page_in()
+                except Exception:
+                    # ошибка одной подгрузки не останавливает планировщик
+                    traceback.print_exc()
+        finally:
+            scheduler.cancel()
+
+    async def recover_missed(self):
+        now = datetime.now()
+        self.loaded_until = now + self.window
+        missed = []
+        for reminder in await self.reminder_manager.get_due(self.loaded_until):
+            if reminder.ended_at <= now:
+                missed.append(reminder)
+            else:
+                self.scheduler.schedule(reminder.id, reminder.ended_at, reminder)
+        if not missed:
+            return
+
+        if self.missed_policy == 'coalesce':
+            # доставка не задерживает завершение запуска
+            self.spawn(self.deliver_coalesced(missed))
+            return
+        if self.missed_policy == 'drop':
+            expired = [reminder.id for reminder in missed if now - reminder.ended_at > self.drop_after]
+            if expired:
+                await self.reminder_manager.delete_many(expired)
+            missed = [reminder for reminder in missed if now - reminder.ended_at <= self.drop_after]
+        await self.fire_reminders(missed)
+
+    async def page_in(self):
+        after = self.loaded_until
+        # окно сдвигается до запроса, чтобы новые напоминания из этого интервала
+        # сразу попадали в планировщик в remind()
+        self.loaded_until = datetime.now() + self.window
+        try:
+            due = await self.reminder_manager.get_due(self.loaded_until, after)
+        except Exception:
+            # неподгруженный интервал будет запрошен повторно
+            self.loaded_until = after
+            raise
+        for reminder in due:
+            self.scheduler.schedule(reminder.id, reminder.ended_at, reminder)
+
+    async def deliver_coalesced(self, reminders: list):
+        grouped = {}
+        for reminder in reminders:
+            grouped.setdefault((reminder.channel_id, reminder.author_id), []).append(reminder)
+
+        deliveries = []
+        for (channel_id, author_id), group in grouped.items():
+            reasons = ''.join(f"\n**{i + 1}**. {reminder.reason} ({reminder.ended_at:%Y-%m-%d %H:%M})"
+                              for i, reminder in enumerate(group))
+            text = f"<@{author_id}>, пока я был недоступен, вы просили напомнить:{reasons}"
+            deliveries.append(self.deliver(channel_id, group, text))
+        await self.finish(await asyncio.gather(*deliveries))
+
+    async def fire_reminders(self, reminders: list):
+        # доставка идет отдельной задачей, чтобы медленный канал не задерживал следующие сроки
+        self.spawn(self.dispatch(reminders))
+
+    async def dispatch(self, reminders: list):
+        """Доставляет напоминания, объединяя наступившие в одну секунду в одном канале
+
+        Доставленные и недоставляемые напоминания удаляются одним запросом,
+        при временной ошибке напоминание перепланируется с увеличивающейся задержкой.
         """
-        dict_rem = ReminderManager.get_by_author(ctx.author.id)
-        embed = Embed(title=f"{ctx.author.nick} напоминания",
-                      color=0x8080ff)
-        for reason, time in dict_rem.items():
-            embed.add_field(name=reason,
-                            value=f"время - {time:%Y-%m-%d %H:%M:%S}",
-                            inline=False)
-        await ctx.send(embed=embed)
-
-    @tasks.loop(seconds=10.0)
-    async def check_reminders(self):
-        delta = timedelta(seconds=10)
-        if self.reminders:
-            now = datetime.now()
-
-            for reminder in self.reminders:
-                is_ready = reminder.ended_at - now < delta and (reminder.ended_at - now).days >= 0
-                if is_ready:
-                    channel = self.bot.get_channel(reminder.channel_id)
-                    user = self.bot.get_user(reminder.author_id)
-                    await channel.send(user.mention + ", напоминаю вам: " + reminder.reason)
-                    ReminderManager.delete_reminder(reminder)
-
-    @check_reminders.before_loop
-    async def before_checking(self):
-        await self.bot.wait_until_ready()
+        grouped = {}
+        for reminder in reminders:
+            key = (reminder.channel_id, reminder.ended_at.replace(microsecond=0))
+            grouped.setdefault(key, []).append(reminder)
+
+        deliveries = [self.deliver(channel_id, group, format_reminders(group))
+                      for (channel_id, _), group in grouped.items()]
+        await self.finish(await asyncio.gather(*deliveries))
+
+    async def finish(self, results: list):
+        finished = [reminder.id for done in results for reminder in done]
+        for reminder_id in finished:
+            self.attempts.pop(reminder_id, None)
+        if finished:
+            try:
+                await self.reminder_manager.delete_many(finished)
+            except Exception:
+                traceback.print_exc()
+
+    async def deliver(self, channel_id: int, reminders: list, text: str) -> list:
+        """Возвращает напоминания, которые больше не нужно хранить"""
+        async with self.delivery_slots:
+            try:
+                channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+                for chunk in split_message(text):
+                    await self.bot.rest.submit(("messages", channel_id), lambda: channel.send(chunk))
+            except (NotFound, Forbidden):
+                print(f'Reminder channel {channel_id} is unavailable, '
+                      f'dropping {len(reminders)} reminder(s).', file=sys.stderr)
+                return reminders
+            except Exception:
+                traceback.print_exc()
+                return self.retry(reminders)
+        return reminders
+
+    def retry(self, reminders: list) -> list:
+        """Перепланирует напоминания с увеличивающейся задержкой и возвращает исчерпавшие попытки"""
+        exhausted = []
+        for reminder in reminders:
+            attempt = self.attempts.get(reminder.id, 0) + 1
+            if attempt >= self.max_attempts:
+                print(f'Giving up on reminder {reminder.id} after {attempt} attempts.', file=sys.stderr)
+                exhausted.append(reminder)
+                continue
+            self.attempts[reminder.id] = attempt
+            delay = timedelta(seconds=min(30 * 2 ** attempt, 900))
+            self.scheduler.schedule(reminder.id, datetime.now() + delay, reminder)
+        return exhausted
 
 
 def setup(bot):
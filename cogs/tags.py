@@ -1,10 +1,15 @@
 from discord.ext import commands
 
-from playhouse.sqlite_ext import *
+from peewee import DateTimeField, DoesNotExist, IntegerField, OperationalError, TextField, fn
+from playhouse.sqlite_ext import AutoIncrementField, FTS5Model, RowIDField, SearchField
 import discord
 import datetime
 import logging
-from Utilities import BaseModel, BotEmbed
+import threading
+from Utilities import BaseModel, BotEmbed, Cache
+from Utilities.NameIndex import NameIndex
+from Utilities.Paginator import KeysetPaginator
+from Utilities.AsyncDatabase import AsyncManager, after_commit
 
 logging.basicConfig(filename='bots_errors.log', level=logging.ERROR)
 logger = logging.getLogger('peewee')
@@ -26,26 +31,79 @@ class Tag(BaseModel.BaseModel):
     category = TextField(default="Общее")
     guild_id = IntegerField(null=False)
 
+    class Meta:
+        indexes = (
+            (('guild_id', 'name'), True),
+        )
+
+
+tag_cache = Cache.LRUCache(maxsize=4096, ttl=600.0)
+tag_names = NameIndex(lambda guild_id: TagManager.get_names(guild_id))
+
+
+def fts_query(phrase: str) -> str:
+    """Запрос FTS5 из фразы пользователя: каждое слово берется в кавычки как строка,
+    поэтому операторы и спецсимволы FTS5 (OR, *, :, ", +) ищутся как текст, а не разбираются"""
+    return " ".join('"' + token.replace('"', '""') + '"' for token in phrase.split())
+
+
+class CategorySummary:
+    """ Класс CategorySummary хранит количество тегов в каждой категории по серверам
+
+    Сводка сервера загружается одним запросом GROUP BY при первом обращении,
+    затем поддерживается инкрементально при создании и удалении тегов.
+
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, guild_id: int) -> list:
+        with self._lock:
+            counts = self._counts.get(guild_id)
+            if counts is None:
+                counts = self._counts[guild_id] = dict(self._loader(guild_id))
+            return sorted(counts.items())
+
+    def add(self, guild_id: int, category: str, delta: int = 1):
+        with self._lock:
+            counts = self._counts.get(guild_id)
+            if counts is None:
+                return
+            count = counts.get(category, 0) + delta
+            if count > 0:
+                counts[category] = count
+            else:
+                counts.pop(category, None)
+
 
-class TagIndex(FTSModel):
+tag_categories = CategorySummary(lambda guild_id: TagManager.get_categories(guild_id))
+
+
+class TagIndex(FTS5Model):
+    """ Класс TagIndex описывает FTS5-индекс по таблице Tags (external content)
+
+        Индекс хранит только токены, содержимое берется из таблицы тегов.
+        Синхронизация выполняется триггерами на таблице тегов, см. migrations.py
+
+        """
     rowid = RowIDField()
     name = SearchField()
     content = SearchField()
 
     class Meta:
         database = BaseModel.database
-        options = {'tokenize': 'porter'}
+        options = {'content': 'tag', 'content_rowid': 'id', 'tokenize': 'porter unicode61'}
 
 
 class TagIndexManager:
 
     @staticmethod
-    def insert_index(tag):
-        TagIndex.insert({
-            TagIndex.rowid: tag.id,
-            TagIndex.name: tag.name,
-            TagIndex.content: tag.content
-        }).execute()
+    def rebuild():
+        """Перестраивает полнотекстовый индекс по текущему содержимому таблицы тегов"""
+        TagIndex.rebuild()
 
 
 class TagManager:
@@ -57,14 +115,25 @@ class TagManager:
     """
 
     @staticmethod
-    def search(phrase: str, guild_id: int):
-        return (Tag
-                .select()
-                .join(
-            TagIndex,
-            on=(Tag.id == TagIndex.rowid))
-                .where((TagIndex.match(phrase)) &
-                       (Tag.guild_id == guild_id)))
+    def search(phrase: str, guild_id: int, limit: int = 10, after: tuple = None) -> list:
+        """Возвращает страницу результатов поиска, упорядоченных по bm25
+
+        Результат - список кортежей (id, name, score, snippet). Для следующей страницы
+        передается after=(score, id) последнего результата предыдущей страницы.
+        """
+        match = fts_query(phrase)
+        if not match:
+            return []
+        score = TagIndex.bm25()
+        query = (Tag
+                 .select(Tag.id, Tag.name, score.alias('score'),
+                         fn.snippet(TagIndex._meta.entity, 1, '**', '**', '…', 8).alias('snippet'))
+                 .join(TagIndex, on=(Tag.id == TagIndex.rowid))
+                 .where((TagIndex.match(match)) &
+                        (Tag.guild_id == guild_id)))
+        if after is not None:
+            query = query.where((score > after[0]) | ((score == after[0]) & (Tag.id > after[1])))
+        return list(query.order_by(score, Tag.id).limit(limit).tuples())
 
     @staticmethod
     def get_names(guild_id: int):
@@ -84,27 +153,65 @@ class TagManager:
         return [tag.name for tag in query]
 
     @staticmethod
-    def get_categories(guild_id: int):
-        query = Tag.select().where(Tag.guild_id == guild_id)
-        return [tag.category for tag in query]
+    def get_categories(guild_id: int) -> list:
+        """Возвращает список кортежей (категория, количество тегов)"""
+        query = (Tag
+                 .select(Tag.category, fn.COUNT(Tag.id))
+                 .where(Tag.guild_id == guild_id)
+                 .group_by(Tag.category))
+        return list(query.tuples())
+
+    @staticmethod
+    def get_category_summary(guild_id: int) -> list:
+        return tag_categories.get(guild_id)
 
     @staticmethod
     def insert_tag(tag: Tag):
         with BaseModel.database.atomic():
             tag.save()
-        TagIndexManager.insert_index(tag)
+
+        def apply():
+            tag_cache.invalidate((tag.guild_id, tag.name))
+            tag_names.add(tag.guild_id, tag.name)
+            tag_categories.add(tag.guild_id, tag.category)
+
+        # индексы в памяти меняются только если пакет записей закоммичен
+        after_commit(apply)
         return True
 
+    @staticmethod
+    def exists(name: str, guild_id: int) -> bool:
+        return tag_names.exists(guild_id, name)
+
+    @staticmethod
+    def complete(prefix: str, guild_id: int, limit: int = 10) -> tuple:
+        """Возвращает до limit имен тегов с данным префиксом и общее количество совпадений"""
+        return tag_names.complete(guild_id, prefix, limit), tag_names.count_prefix(guild_id, prefix)
+
+    @staticmethod
+    def get_names_page(guild_id: int, after: str = None, limit: int = 10) -> list:
+        return tag_names.page(guild_id, after, limit)
+
+    @staticmethod
+    def get_cached(name: str, guild_id: int):
+        """Возвращает тег (или None для несуществующего) из кэша без обращения к БД, иначе Cache.MISSING"""
+        return tag_cache.get((guild_id, name))
+
+    @staticmethod
+    def load_by_name(name: str, guild_id: int):
+        """Читает тег из БД и кэширует результат, в том числе отсутствие тега"""
+        generation = tag_cache.generation
+        tag = Tag.get_or_none((Tag.name == name) &
+                              (Tag.guild_id == guild_id))
+        tag_cache.put((guild_id, name), tag, generation)
+        return tag
+
     @staticmethod
     def get_by_name(name: str, guild_id: int):
-        try:
-            tag = Tag.get((Tag.name == name) &
-                          (Tag.guild_id == guild_id))
-        except DoesNotExist as ex:
-            logger.exception(ex)
-            logger.exception(f"\nTag with name {name} doesn't exist!\n")
-        else:
-            return tag
+        tag = tag_cache.get((guild_id, name))
+        if tag is Cache.MISSING:
+            tag = TagManager.load_by_name(name, guild_id)
+        return tag
 
     @staticmethod
     def delete_tag(name: str, guild_id: int):
@@ -114,7 +221,11 @@ class TagManager:
             logger.exception(ex)
             logger.exception(f"\nTag with name {name} doesn't exist!\n")
         else:
-            return tag.delete_instance()
+            deleted = tag.delete_instance()
+            tag_cache.invalidate((guild_id, tag.name))
+            tag_names.remove(guild_id, tag.name)
+            tag_categories.add(guild_id, tag.category, -1)
+            return deleted
 
     @staticmethod
     def update_content(name: str, content: str, guild_id: int):
@@ -125,18 +236,19 @@ class TagManager:
             logger.exception(f"\nTag with name {name} doesn't exist!\n")
         else:
             tag.content = content
-            return tag.save()
-
-    @staticmethod
-    def init_db():
-        BaseModel.database.connect()
-        BaseModel.database.create_tables([TagIndex, Tag], safe=True)
-        BaseModel.database.close()
+            updated = tag.save()
+            tag_cache.invalidate((guild_id, tag.name))
+            return updated
 
 
 class Tags(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.tag_manager = AsyncManager(TagManager, bot.db, batched=("insert_tag",), writes=(
+            "delete_tag", "update_content",
+            # заполняют кэш тегов, индекс имен и сводку категорий, которые меняются записями
+            "load_by_name", "get_by_name", "exists", "complete", "get_names_page", "get_category_summary",
+        ))
 
     @commands.group(name="тег", invoke_without_command=True)
     @commands.guild_only()
@@ -147,7 +259,9 @@ class Tags(commands.Cog):
         if tag_name is None:
             await ctx.send("Введите аргументы")
         else:
-            tag = TagManager.get_by_name(tag_name.lower(), ctx.guild.id)
+            tag = TagManager.get_cached(tag_name.lower(), ctx.guild.id)
+            if tag is Cache.MISSING:
+                tag = await self.tag_manager.load_by_name(tag_name.lower(), ctx.guild.id)
             if tag is None:
                 await ctx.send(f"Тег с названием \"{tag_name}\" не существует!")
             else:
@@ -161,9 +275,10 @@ class Tags(commands.Cog):
             return ctx.channel == msg.channel and msg.author == ctx.author
 
         if tag_name is not None:
-            if tag_name.lower() in TagManager.get_names(ctx.guild.id):
+            if await self.tag_manager.exists(tag_name.lower(), ctx.guild.id):
                 await ctx.send("Такое имя уже существует, попробуйте другое")
-            elif tag_name.lower() in ["создать", "мои", "удалить", "поиск", "изменить", "все", "категория"]:
+            elif tag_name.lower() in ["создать", "мои", "удалить", "поиск", "изменить", "все", "категория", "кэш",
+                                      "подсказка", "переиндексировать"]:
                 await ctx.send("Это служебное слово, выберите другое название")
             else:
                 await ctx.send("Введите содержимое тега и категорию в кавычках при наличии:")
@@ -190,7 +305,7 @@ class Tags(commands.Cog):
                     category=category,
                     guild_id=ctx.guild.id
                 )
-                if TagManager.insert_tag(tag):
+                if await self.tag_manager.insert_tag(tag):
                     await ctx.send("Тег создан!")
                 else:
                     await ctx.send("Ошибка при создании тега.")
@@ -205,10 +320,10 @@ class Tags(commands.Cog):
             def check_author(msg_id):
                 return str(ctx.author.id) == msg_id
 
-            tag = TagManager.get_by_name(tag_name, ctx.guild.id)
+            tag = await self.tag_manager.get_by_name(tag_name.lower(), ctx.guild.id)
             if tag is not None:
                 if check_author(tag.author):
-                    TagManager.delete_tag(tag.name, ctx.guild.id)
+                    await self.tag_manager.delete_tag(tag.name, ctx.guild.id)
                     await ctx.send("Успешно удалено!")
                 else:
                     await ctx.send("Ошибка доступа: вы не являетесь автором тега.")
@@ -228,13 +343,13 @@ class Tags(commands.Cog):
             def check_author(msg_id):
                 return str(ctx.author.id) == msg_id
 
-            tag = TagManager.get_by_name(tag_name, ctx.guild.id)
+            tag = await self.tag_manager.get_by_name(tag_name.lower(), ctx.guild.id)
             if tag is not None:
                 if check_author(tag.author):
                     await ctx.send("Введите новое значение:")
                     message = await self.bot.wait_for('message', check=check)
                     content = message.content
-                    TagManager.update_content(tag_name, content, ctx.guild.id)
+                    await self.tag_manager.update_content(tag.name, content, ctx.guild.id)
                     await ctx.send("Успешно обновлено")
                 else:
                     await ctx.send("Ошибка доступа: вы не являетесь автором тега.")
@@ -246,16 +361,19 @@ class Tags(commands.Cog):
     @tag.command(name="все")
     async def all_tags(self, ctx):
         """Выводит все теги на сервере"""
-        tags = TagManager.get_names(ctx.guild.id)
+        def fetch_page(after, limit):
+            return self.tag_manager.get_names_page(ctx.guild.id, after, limit)
 
-        embed = BotEmbed.BotEmbed(self.bot.user, title=f"{ctx.guild.name}")
-        embed.add_enumerated_field(tags, name="Список тегов")
-        await ctx.send(embed=embed)
+        render = BotEmbed.enumerated_page(lambda: BotEmbed.BotEmbed(self.bot.user, title=f"{ctx.guild.name}"),
+                                          "Список тегов")
+        paginator = KeysetPaginator(ctx, fetch_page, key=lambda name: name, render=render)
+        if not await paginator.start():
+            await ctx.send("На сервере нет тегов")
 
     @tag.command(name="мои")
     async def my_tags(self, ctx):
         """Выводит теги пользователя, вызвавшего команду"""
-        tags = TagManager.get_by_author(ctx.author.id, ctx.guild.id)
+        tags = await self.tag_manager.get_by_author(ctx.author.id, ctx.guild.id)
         if tags:
             embed = BotEmbed.BotEmbed(self.bot.user, title=f"Теги {ctx.author.nick}")
             embed.add_enumerated_field(tags, name="Список тегов")
@@ -266,14 +384,22 @@ class Tags(commands.Cog):
     @tag.command(name="поиск")
     async def search_tag(self, ctx, *, phrase: str = None):
         """Выводит теги, соответствующие указанному слову/фразе"""
+        if phrase is None:
+            return await ctx.send("Введите слово или фразу для поиска")
 
-        result = [tag.name for tag in TagManager.search(phrase, ctx.guild.id)]
-        if result:
-            embed = BotEmbed.BotEmbed(self.bot.user, title=f"Поиск по \"{phrase}\"")
-            embed.add_enumerated_field(result, name="Вам могут подойти")
-            await ctx.send(embed=embed)
+        def fetch_page(after, limit):
+            return self.tag_manager.search(phrase, ctx.guild.id, limit, after)
+
+        render = BotEmbed.enumerated_page(lambda: BotEmbed.BotEmbed(self.bot.user, title=f"Поиск по \"{phrase}\""),
+                                          "Вам могут подойти", lambda row: f"{row[1]} — {row[3][:80]}")
+        paginator = KeysetPaginator(ctx, fetch_page, key=lambda row: (row[2], row[0]), render=render)
+        try:
+            found = await paginator.start()
+        except OperationalError:
+            await ctx.send("Некорректный поисковый запрос")
         else:
-            await ctx.send("Не найдено совпадений!")
+            if not found:
+                await ctx.send("Не найдено совпадений!")
 
     @tag.command(name="категория")
     async def category_tag(self, ctx, *, category: str = None):
@@ -281,13 +407,14 @@ class Tags(commands.Cog):
         if category is None:
             await ctx.send("Введите нужную вам категорию или 'все' для отображения списка категорий")
         elif category == 'все':
-            categories = set(TagManager.get_categories(ctx.guild.id))
+            categories = await self.tag_manager.get_category_summary(ctx.guild.id)
             embed = BotEmbed.BotEmbed(self.bot.user, title=f"{ctx.guild.name}")
-            embed.add_enumerated_field(categories, name="Список категорий тегов")
+            embed.add_enumerated_field([f"{name} — {count}" for name, count in categories],
+                                       name="Список категорий тегов")
             await ctx.send(embed=embed)
 
         else:
-            tags = TagManager.get_by_category(category, ctx.guild.id)
+            tags = await self.tag_manager.get_by_category(category, ctx.guild.id)
             if tags:
                 embed = BotEmbed.BotEmbed(self.bot.user, title=f"{category}")
                 embed.add_enumerated_field(tags, name="Список тегов")
@@ -295,6 +422,35 @@ class Tags(commands.Cog):
             else:
                 await ctx.send("Такая категория отсутствует")
 
+    @tag.command(name="подсказка")
+    async def suggest_tag(self, ctx, *, prefix: str = None):
+        """Выводит названия тегов, начинающиеся с указанных символов"""
+        if prefix is None:
+            return await ctx.send("Введите начало названия тега")
+        names, total = await self.tag_manager.complete(prefix.lower(), ctx.guild.id)
+        if names:
+            embed = BotEmbed.BotEmbed(self.bot.user, title=f"Теги на \"{prefix}\"")
+            name = "Вам могут подойти" if total <= len(names) else f"Вам могут подойти ({len(names)} из {total})"
+            embed.add_enumerated_field(names, name=name)
+            await ctx.send(embed=embed)
+        else:
+            await ctx.send("Не найдено совпадений!")
+
+    @tag.command(name="переиндексировать", hidden=True)
+    @commands.is_owner()
+    async def rebuild_index(self, ctx):
+        """Перестраивает полнотекстовый индекс тегов"""
+        await self.bot.db.run(TagIndexManager.rebuild)
+        await ctx.send("Индекс тегов перестроен")
+
+    @tag.command(name="кэш", hidden=True)
+    @commands.is_owner()
+    async def cache_stats(self, ctx):
+        """Выводит статистику кэша тегов"""
+        stats = tag_cache.stats()
+        await ctx.send(f"Записей: **{stats['size']}**/{stats['maxsize']}, попаданий: **{stats['hits']}**, "
+                       f"промахов: **{stats['misses']}**, доля попаданий: **{stats['hit_rate']:.1%}**")
+
 
 def setup(bot):
     bot.add_cog(Tags(bot))
@@ -0,0 +1 @@
+# Корень репозитория попадает в sys.path, тесты импортируют Utilities и cogs как бот
@@ -0,0 +1,137 @@
+"""
+Версионированные миграции схемы БД.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+один раз в отдельной транзакции при запуске бота, до загрузки расширений.
+"""
+from cogs import Polls, reminder, Study, tags, Utils
+
+MIGRATIONS = []
+
+
+def migration(version: int):
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return decorator
+
+
+def get_version(database) -> int:
+    return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def add_column(database, table: str, column: str, definition: str):
+    if column not in {info.name for info in database.get_columns(table)}:
+        database.execute_sql(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def migrate(database) -> list:
+    """Применяет недостающие миграции и возвращает номера примененных версий"""
+    current = get_version(database)
+    applied = []
+    for version, step in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version <= current:
+            continue
+        with database.atomic():
+            step(database)
+            database.execute_sql(f"PRAGMA user_version = {int(version)}")
+        applied.append(version)
+    return applied
+
+
+@migration(1)
+def create_schema(database):
+    """Базовая схема: удаление дубликатов, мешающих уникальным индексам, и создание таблиц"""
+    if database.table_exists('student'):
+        database.execute_sql(
+            "UPDATE doneexercises SET student_id = ("
+            " SELECT MIN(s2.id) FROM student AS s1"
+            " JOIN student AS s2 ON s2.member_id = s1.member_id AND s2.guild_id = s1.guild_id"
+            " WHERE s1.id = doneexercises.student_id)")
+        database.execute_sql(
+            "DELETE FROM student WHERE id NOT IN (SELECT MIN(id) FROM student GROUP BY member_id, guild_id)")
+    if database.table_exists('tag'):
+        database.execute_sql("DELETE FROM tag WHERE id NOT IN (SELECT MIN(id) FROM tag GROUP BY guild_id, name)")
+        if database.table_exists('tagindex'):
+            database.execute_sql("DELETE FROM tagindex WHERE rowid NOT IN (SELECT id FROM tag)")
+    database.execute_sql("DROP INDEX IF EXISTS groups_group_name")
+
+    database.create_tables([tags.Tag, tags.TagIndex, reminder.Reminders,
+                            Study.Groups, Study.Student, Study.Exercise, Study.DoneExercises,
+                            Utils.RoleMessages], safe=True)
+
+
+@migration(2)
+def create_lookup_indexes(database):
+    """Индексы горячих выборок"""
+    for statement in (
+            "CREATE INDEX IF NOT EXISTS exercise_guild_id_title ON exercise (guild_id, title)",
+            "CREATE INDEX IF NOT EXISTS reminders_ended_at ON reminders (ended_at)",
+            "CREATE INDEX IF NOT EXISTS rolemessages_message_id ON rolemessages (message_id)",
+    ):
+        database.execute_sql(statement)
+
+
+@migration(3)
+def add_role_message_role_id(database):
+    """Хранение ID роли вместо поиска роли по имени при каждой реакции"""
+    add_column(database, 'rolemessages', 'role_id', 'INTEGER')
+
+
+@migration(4)
+def create_tag_fts5_index(database):
+    """FTS5-индекс тегов с внешним содержимым, синхронизируемый триггерами"""
+    for statement in (
+            "DROP TABLE IF EXISTS tagindex",
+            "CREATE VIRTUAL TABLE tagindex USING fts5("
+            " name, content, content='tag', content_rowid='id', tokenize='porter unicode61')",
+            "CREATE TRIGGER IF NOT EXISTS tag_after_insert AFTER INSERT ON tag BEGIN"
+            " INSERT INTO tagindex(rowid, name, content) VALUES (new.id, new.name, new.content);"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS tag_after_delete AFTER DELETE ON tag BEGIN"
+            " INSERT INTO tagindex(tagindex, rowid, name, content) VALUES ('delete', old.id, old.name, old.content);"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS tag_after_update AFTER UPDATE OF name, content ON tag BEGIN"
+            " INSERT INTO tagindex(tagindex, rowid, name, content) VALUES ('delete', old.id, old.name, old.content);"
+            " INSERT INTO tagindex(rowid, name, content) VALUES (new.id, new.name, new.content);"
+            " END",
+            "INSERT INTO tagindex(tagindex) VALUES ('rebuild')",
+    ):
+        database.execute_sql(statement)
+
+
+@migration(5)
+def create_tag_category_index(database):
+    """Индекс для выборки и группировки тегов по категориям"""
+    database.execute_sql("CREATE INDEX IF NOT EXISTS tag_guild_id_category ON tag (guild_id, category)")
+
+
+@migration(6)
+def create_reminder_author_index(database):
+    """Индекс для постраничного вывода напоминаний автора"""
+    database.execute_sql("CREATE INDEX IF NOT EXISTS reminders_author_id_ended_at ON reminders (author_id, ended_at)")
+
+
+@migration(7)
+def create_poll_tables(database):
+    """Таблицы опросов и голосов"""
+    database.create_tables([Polls.Poll, Polls.PollVote], safe=True)
+
+
+@migration(8)
+def create_gradebook_tables(database):
+    """Таблицы сводки сдачи работ и их заполнение по уже сданным работам"""
+    database.create_tables([Study.GradebookCell, Study.ExerciseProgress, Study.StudentProgress], safe=True)
+    Study.GradebookManager.rebuild()
+
+
+@migration(9)
+def add_group_auto_sync(database):
+    """Признак автоматического обновления студентов группы по ролям"""
+    add_column(database, 'groups', 'auto_sync', 'INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(10)
+def create_guild_prefix_table(database):
+    """Префиксы команд серверов"""
+    database.create_tables([Utils.GuildPrefix], safe=True)
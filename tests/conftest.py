@@ -0,0 +1,48 @@
+import json
+from contextlib import contextmanager
+
+import pytest
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """БД бота во временном файле со всеми примененными миграциями"""
+    pytest.importorskip("peewee")
+    pytest.importorskip("discord")
+    path = str(tmp_path / "bot.db")
+    (tmp_path / "config.json").write_text(json.dumps({"database": path}))
+    monkeypatch.chdir(tmp_path)
+
+    from Utilities import BaseModel
+    import migrations
+
+    BaseModel.database.init(path, pragmas=dict(journal_mode='wal', foreign_keys=1))
+    BaseModel.database.connect(reuse_if_open=True)
+    migrations.migrate(BaseModel.database)
+    yield BaseModel.database
+    BaseModel.database.close()
+
+
+@pytest.fixture
+def query_budget():
+    """Контекстный менеджер, падающий, если блок выполнил больше limit запросов к БД
+
+    Результат должен быть прочитан внутри блока, иначе ленивые запросы не попадут в подсчет.
+    """
+    @contextmanager
+    def budget(database, limit: int):
+        executed = []
+        execute_sql = database.execute_sql
+
+        def counting(sql, params=None, *args, **kwargs):
+            executed.append(sql)
+            return execute_sql(sql, params, *args, **kwargs)
+
+        database.execute_sql = counting
+        try:
+            yield executed
+        finally:
+            del database.execute_sql
+        assert len(executed) <= limit, \
+            f"{len(executed)} запросов к БД при бюджете {limit}:\n" + "\n".join(executed)
+    return budget
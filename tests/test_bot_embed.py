@@ -0,0 +1,16 @@
+import pytest
+
+BotEmbed = pytest.importorskip("Utilities.BotEmbed", exc_type=ImportError)
+
+
+def test_fits_without_ellipsis():
+    assert BotEmbed.enumerated_lines(["a", "b"]) == "**1**. a\n**2**. b\n"
+
+
+@pytest.mark.parametrize("limit", [9, 10, 18, 19, 20, 30])
+def test_truncated_within_limit(limit):
+    # каждая строка "**n**. x\n" занимает 9 символов
+    content = BotEmbed.enumerated_lines(["x"] * 10, limit=limit)
+    assert content.endswith("…")
+    assert len(content) <= limit
+    assert content[:-1].count("\n") == (limit - 1) // 9
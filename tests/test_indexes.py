@@ -0,0 +1,30 @@
+import pytest
+
+# выборки горячих путей, которые должны идти по индексу, а не полным сканированием таблицы
+INDEX_PROBES = (
+    ("тег по имени", "SELECT * FROM tag WHERE guild_id = ? AND name = ?", (0, "")),
+    ("категории тегов", "SELECT category, COUNT(id) FROM tag WHERE guild_id = ? GROUP BY category", (0,)),
+    ("студент по участнику", "SELECT * FROM student WHERE member_id = ? AND guild_id = ?", (0, 0)),
+    ("задание по названию", "SELECT * FROM exercise WHERE guild_id = ? AND title = ?", (0, "")),
+    ("группа по названию", "SELECT * FROM groups WHERE guild_id = ? AND group_name = ?", (0, "")),
+    ("ближайшие напоминания", "SELECT * FROM reminders WHERE ended_at <= ? ORDER BY ended_at", ("",)),
+    ("напоминания автора", "SELECT id, ended_at, reason FROM reminders WHERE author_id = ? "
+                           "ORDER BY ended_at, id LIMIT 11", (0,)),
+    ("несдавшие задание", "SELECT member_id FROM student WHERE guild_id = ? AND group_id = ? AND NOT EXISTS "
+                          "(SELECT id FROM gradebookcell WHERE student_id = student.id AND exercise_id = ?)",
+     (0, 0, 0)),
+    ("сообщение для роли", "SELECT * FROM rolemessages WHERE message_id = ?", (0,)),
+)
+
+
+def explain(database, sql: str, params: tuple = ()) -> list:
+    cursor = database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+@pytest.mark.parametrize("name, sql, params", INDEX_PROBES, ids=[name for name, _, _ in INDEX_PROBES])
+def test_uses_index(database, name, sql, params):
+    plan = explain(database, sql, params)
+    scans = [step for step in plan if step.startswith(("SCAN", "SEARCH"))]
+    assert scans
+    assert all(" USING " in step for step in scans), "; ".join(plan)
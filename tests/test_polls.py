@@ -0,0 +1,62 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+pytest.importorskip("peewee")
+pytest.importorskip("discord")
+
+
+@pytest.fixture
+def cog(database):
+    from cogs.Polls import PollState, Polls
+
+    poll = SimpleNamespace(id=1, message_id=500, channel_id=50, guild_id=1, author_id=10, question="Когда зачет?",
+                           options=json.dumps(["Пн", "Вт"]), closes_at=None)
+    cog = Polls.__new__(Polls)
+    cog.bot = MagicMock()
+    cog.polls = {poll.message_id: PollState(poll)}
+    cog.close_poll = AsyncMock()
+    return cog
+
+
+def make_ctx(guild_id: int, author_id: int = 20):
+    return SimpleNamespace(guild=SimpleNamespace(id=guild_id), author=SimpleNamespace(id=author_id),
+                           channel=MagicMock(), send=AsyncMock())
+
+
+def test_results_from_other_guild(cog):
+    ctx = make_ctx(guild_id=2)
+    asyncio.run(cog.poll_results.callback(cog, ctx, 500))
+    ctx.send.assert_awaited_once_with("Открытый опрос с таким ID сообщения не найден")
+
+
+def test_close_from_other_guild(cog):
+    ctx = make_ctx(guild_id=2, author_id=10)
+    ctx.channel.permissions_for.return_value.manage_messages = True
+    asyncio.run(cog.close_poll_command.callback(cog, ctx, 500))
+    cog.close_poll.assert_not_awaited()
+    ctx.send.assert_awaited_once_with("Открытый опрос с таким ID сообщения не найден")
+
+
+def test_close_checks_poll_channel(cog):
+    ctx = make_ctx(guild_id=1)
+    # модератор канала команды, но не канала опроса
+    ctx.channel.permissions_for.return_value.manage_messages = True
+    cog.bot.get_channel.return_value.permissions_for.return_value.manage_messages = False
+    asyncio.run(cog.close_poll_command.callback(cog, ctx, 500))
+    cog.close_poll.assert_not_awaited()
+    cog.bot.get_channel.assert_called_once_with(50)
+
+    cog.bot.get_channel.return_value.permissions_for.return_value.manage_messages = True
+    asyncio.run(cog.close_poll_command.callback(cog, ctx, 500))
+    cog.close_poll.assert_awaited_once()
+
+
+def test_author_closes_without_permission(cog):
+    ctx = make_ctx(guild_id=1, author_id=10)
+    cog.bot.get_channel.return_value.permissions_for.return_value.manage_messages = False
+    asyncio.run(cog.close_poll_command.callback(cog, ctx, 500))
+    cog.close_poll.assert_awaited_once()
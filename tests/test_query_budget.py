@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+
+GUILD = 1
+
+
+@pytest.fixture
+def group(database):
+    from cogs.Study import DoneExerciseManager, DoneExercises, Exercise, Groups, Student
+
+    group = Groups.create(group_name="ПИ-21", guild_id=GUILD)
+    students = [Student.create(member_id=100 + i, group_id=group, guild_id=GUILD) for i in range(5)]
+    exercises = [Exercise.create(title=f"Лаба {i}", content="...", group_id=group, guild_id=GUILD)
+                 for i in range(20)]
+    for exercise in exercises:
+        for student in students[:3]:
+            DoneExerciseManager.insert(DoneExercises(student=student, exercise=exercise,
+                                                     done_at=datetime(2026, 10, 18), student_result="ok"))
+    return group
+
+
+def test_exercises_by_student(database, group, query_budget):
+    from cogs.Study import ExerciseManager
+
+    with query_budget(database, 1):
+        titles = ExerciseManager.get_by_student(100, GUILD)
+    assert len(titles) == 20
+
+
+def test_done_exercises_by_student(database, group, query_budget):
+    from cogs.Study import DoneExerciseManager
+
+    with query_budget(database, 1):
+        done = DoneExerciseManager.get_by_student(100, GUILD)
+    assert len(done) == 20
+    assert done[0] == ("Лаба 0", datetime(2026, 10, 18))
+
+
+def test_gradebook_matrix(database, group, query_budget):
+    from cogs.Study import GradebookManager
+
+    with query_budget(database, 4):
+        students, exercises, cells = GradebookManager._read_matrix("ПИ-21", GUILD)
+    assert len(students) == 5
+    assert len(exercises) == 20
+    assert len(cells) == 60
+
+
+def test_missing_submissions(database, group, query_budget):
+    from cogs.Study import GradebookManager
+
+    with query_budget(database, 2):
+        missing = GradebookManager.get_missing("Лаба 0", GUILD)
+    assert missing == [103, 104]
+
+
+def test_budget_overrun_fails(database, group, query_budget):
+    from cogs.Study import Student
+
+    with pytest.raises(AssertionError):
+        with query_budget(database, 1):
+            for student in Student.select():
+                student.group_id.group_name
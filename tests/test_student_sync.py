@@ -0,0 +1,20 @@
+from datetime import datetime
+
+GUILD = 1
+
+
+def test_sync_keeps_students_with_submissions(database):
+    from cogs.Study import DoneExerciseManager, DoneExercises, Exercise, Groups, Student, StudentManager
+
+    group = Groups.create(group_name="ПИ-21", guild_id=GUILD)
+    students = [Student.create(member_id=100 + i, group_id=group, guild_id=GUILD) for i in range(4)]
+    exercise = Exercise.create(title="Лаба 1", content="...", group_id=group, guild_id=GUILD)
+    DoneExerciseManager.insert(DoneExercises(student=students[0], exercise=exercise,
+                                             done_at=datetime(2026, 10, 18), student_result="ok"))
+
+    # роль осталась у 102 и появилась у 200; 100 со сданной работой и 101, 103 роль потеряли
+    inserted, updated, removed, kept = StudentManager.sync_group("ПИ-21", GUILD, [102, 200])
+
+    assert (inserted, updated, removed, kept) == (1, 0, 2, 1)
+    members = {member_id for member_id, in Student.select(Student.member_id).where(Student.group_id == group).tuples()}
+    assert members == {100, 102, 200}
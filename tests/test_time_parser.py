@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import pytest
+
+from Utilities.TimeParser import TimeParseError, parse
+
+NOW = datetime(2026, 10, 18, 12, 0)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("через 10 минут", datetime(2026, 10, 18, 12, 10)),
+    ("через 1 час 30 минут", datetime(2026, 10, 18, 13, 30)),
+    ("через час", datetime(2026, 10, 18, 13, 0)),
+    ("через 2 дня и 3 часа", datetime(2026, 10, 20, 15, 0)),
+    ("через 45 секунд", datetime(2026, 10, 18, 12, 0, 45)),
+    ("в 18:00", datetime(2026, 10, 18, 18, 0)),
+    ("в 9:30", datetime(2026, 10, 19, 9, 30)),
+    ("на 7 вечера", datetime(2026, 10, 18, 19, 0)),
+    ("в 7 утра", datetime(2026, 10, 19, 7, 0)),
+    ("в 12 ночи", datetime(2026, 10, 19, 0, 0)),
+    ("завтра в 9", datetime(2026, 10, 19, 9, 0)),
+    ("25.12 в 18:30", datetime(2026, 12, 25, 18, 30)),
+    ("в 10:00 01.01", datetime(2027, 1, 1, 10, 0)),
+    ("01.02.2027 в 8 утра", datetime(2027, 2, 1, 8, 0)),
+])
+def test_parses(text, expected):
+    assert parse(text, NOW) == expected
+
+
+@pytest.mark.parametrize("text, code", [
+    ("", "empty"),
+    ("через", "missing_duration"),
+    ("через 10", "missing_unit"),
+    ("через 10 лет", "unknown_unit"),
+    ("через 0 минут", "non_positive"),
+    ("в 25:00", "bad_time"),
+    ("в 0 вечера", "bad_time"),
+    ("в 13 утра", "bad_time"),
+    ("в", "missing_time"),
+    ("завтра", "missing_time"),
+    ("31.02 в 10:00", "bad_date"),
+    ("01.01.2020 в 10:00", "in_past"),
+    ("через 400 дней", "too_far"),
+    ("через 99999999999999 дней", "too_far"),
+    ("когда-нибудь", "unknown_token"),
+])
+def test_rejects(text, code):
+    with pytest.raises(TimeParseError) as error:
+        parse(text, NOW)
+    assert error.value.code == code